@@ -0,0 +1,227 @@
+"""Actor processes that collect experience in parallel to the learner."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from inference import NumpyInference
+import play
+import replay_memory
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+# Maximum number of actions per game played by an actor
+ACTOR_MAX_STEPS = 1000
+
+# Number of experiences per shared-memory slot; longer games use several
+SLOT_ROWS = 256
+
+# Number of shared-memory slots of every actor. An actor waits for a free
+# slot when all of its slots are waiting for the learner.
+SLOTS_PER_ACTOR = 8
+
+# Columns of the shared-memory slots: name -> (ctypes typecode, numpy dtype,
+# row shape), matching play.experiences_to_columns()
+SLOT_COLUMNS = {
+    "states": ("f", np.float32, (replay_memory.NUM_ELEMENTS_IN_STATE,)),
+    "actions": ("i", np.int32, ()),
+    "rewards": ("f", np.float32, ()),
+    "next_states": ("f", np.float32, (replay_memory.NUM_ELEMENTS_IN_STATE,)),
+    "game_over": ("b", np.bool_, ()),
+    "not_available": ("b", np.bool_, ()),
+    "truncated": ("b", np.bool_, ()),
+}
+
+
+def _slot_views(shared_columns):
+  """Returns numpy views (num_slots, SLOT_ROWS, ...) of the shared columns."""
+
+  views = {}
+  for name, (_, dtype, row_shape) in SLOT_COLUMNS.items():
+    views[name] = np.frombuffer(shared_columns[name], dtype=dtype).reshape(
+        (-1, SLOT_ROWS) + row_shape)
+  return views
+
+
+def _actor_main(actor_id, shapes, shared_parameters, parameters_version,
+                epsilon, steps, shared_columns, free_slots, filled_slots,
+                max_steps):
+  """Main loop of an actor process.
+
+  Plays games with an epsilon-greedy strategy against the latest broadcast
+  parameters. The experiences of every game are written into free slots of
+  the shared columns, and (actor_id, slot, count) of every filled slot is put
+  into filled_slots.
+  """
+  np.random.seed((os.getpid() * 1000 + actor_id) % (2 ** 32))
+
+  sizes = [int(np.prod(shape)) for shape in shapes]
+  num_layers = len(shapes) // 2
+  engine = NumpyInference()
+  version = -1
+  slots = _slot_views(shared_columns)
+
+  while True:
+    if parameters_version.value != version:
+      with shared_parameters.get_lock():
+        version = parameters_version.value
+        flat = np.frombuffer(shared_parameters.get_obj(), dtype=np.float32)
+        parameters = []
+        offset = 0
+        for shape, size in zip(shapes, sizes):
+          parameters.append(flat[offset:offset + size].reshape(shape).copy())
+          offset += size
+      engine.set_parameters(parameters[:num_layers], parameters[num_layers:])
+
+    strategy = play.make_epsilon_greedy_strategy(engine.get_q_values,
+                                                 epsilon.value)
+    experiences = play.Follow(strategy, max_steps=max_steps)
+    if not experiences:
+      continue
+    columns = play.experiences_to_columns(experiences)
+    for start in range(0, len(experiences), SLOT_ROWS):
+      count = min(SLOT_ROWS, len(experiences) - start)
+      slot = free_slots.get()
+      for name in SLOT_COLUMNS:
+        slots[name][slot, :count] = columns[name][start:start + count]
+      filled_slots.put((actor_id, slot, count))
+    with steps.get_lock():
+      steps[actor_id] += len(experiences)
+
+
+class ActorPool(object):
+  """Runs num_actors processes that play games and feed a replay memory.
+
+  The learner broadcasts the model parameters with broadcast(), the actors
+  pick them up before their next game. Experiences come back through
+  shared-memory slots: an actor writes a game into its free slots and only
+  sends the slot numbers through a queue; drain() copies the slots into the
+  replay memory and hands them back. The actors are started with the "spawn"
+  method, as forking a process that runs TensorFlow can deadlock, and only
+  import numpy.
+  """
+
+  def __init__(self, num_actors, parameters, max_steps=ACTOR_MAX_STEPS):
+    """Init ActorPool and start the actor processes.
+
+    Args:
+      num_actors: Number of actor processes.
+      parameters: List of numpy arrays, the model weights followed by the
+          model biases, e.g. session.run(model.weights + model.biases).
+      max_steps: Maximum number of actions per game.
+    """
+    self.num_actors = num_actors
+    context = multiprocessing.get_context("spawn")
+    shapes = [np.shape(parameter) for parameter in parameters]
+    size = sum(int(np.prod(shape)) for shape in shapes)
+    self._shared_parameters = context.Array("f", size)
+    self._parameters_version = context.Value("i", 0)
+    self._epsilon = context.Value("d", 1.0)
+    self._steps = context.Array("l", num_actors)
+    num_slots = num_actors * SLOTS_PER_ACTOR
+    self._shared_columns = {
+        name: context.RawArray(typecode,
+                               num_slots * SLOT_ROWS *
+                               int(np.prod(row_shape, dtype=np.int64)))
+        for name, (typecode, _, row_shape) in SLOT_COLUMNS.items()}
+    self._slots = _slot_views(self._shared_columns)
+    self._filled_slots = context.Queue()
+    self._free_slots = []
+    for actor_id in range(num_actors):
+      free_slots = context.Queue()
+      for slot in range(actor_id * SLOTS_PER_ACTOR,
+                        (actor_id + 1) * SLOTS_PER_ACTOR):
+        free_slots.put(slot)
+      self._free_slots.append(free_slots)
+    self.broadcast(parameters)
+
+    self._start_time = time.time()
+    self._processes = []
+    for actor_id in range(num_actors):
+      process = context.Process(
+          target=_actor_main,
+          args=(actor_id, shapes, self._shared_parameters,
+                self._parameters_version, self._epsilon, self._steps,
+                self._shared_columns, self._free_slots[actor_id],
+                self._filled_slots, max_steps))
+      process.daemon = True
+      process.start()
+      self._processes.append(process)
+
+
+  def broadcast(self, parameters):
+    """Publishes new model parameters to the actors."""
+
+    flat = np.concatenate([np.ravel(parameter) for parameter in parameters])
+    with self._shared_parameters.get_lock():
+      np.frombuffer(self._shared_parameters.get_obj(),
+                    dtype=np.float32)[:] = flat
+      self._parameters_version.value += 1
+
+
+  def set_epsilon(self, epsilon):
+    """Sets the epsilon the actors use for their next games."""
+
+    self._epsilon.value = epsilon
+
+
+  def drain(self, memory, block=False):
+    """Adds all filled slots waiting in the queue to memory.
+
+    Args:
+      memory: ReplayMemory to add the experiences to.
+      block: If set, waits until at least one game is available.
+
+    Returns:
+      Number of experiences added.
+    """
+
+    added = 0
+    while True:
+      try:
+        actor_id, slot, count = self._filled_slots.get(
+            block=block and added == 0)
+      except queue.Empty:
+        return added
+      memory.add_batch(**{name: self._slots[name][slot, :count]
+                          for name in SLOT_COLUMNS})
+      self._free_slots[actor_id].put(slot)
+      added += count
+
+
+  def throughput(self):
+    """Returns a (num_actors,) array with the steps/second of every actor."""
+
+    elapsed = max(time.time() - self._start_time, 1e-8)
+    with self._steps.get_lock():
+      steps = np.array(self._steps[:], dtype=np.float64)
+    return steps / elapsed
+
+
+  def print_throughput(self):
+    """Prints the steps/second of every actor and of all actors together."""
+
+    throughput = self.throughput()
+    print("Actor throughput (steps/s):")
+    for actor_id, steps_per_second in enumerate(throughput):
+      print("  Actor %d: %.1f" % (actor_id, steps_per_second))
+    print("  Total  : %.1f" % throughput.sum())
+
+
+  def stop(self):
+    """Terminates the actor processes."""
+
+    for process in self._processes:
+      process.terminate()
+    for process in self._processes:
+      process.join()
+    self._processes = []
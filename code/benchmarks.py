@@ -0,0 +1,423 @@
+"""Benchmarks of imports, simulation, replay memory, batching and training.
+
+Every benchmark is seeded and runs on the CPU with a fixed timestep, so
+reports of the same code on the same machine are comparable. Usage:
+
+  python benchmarks.py --output report.json
+  python benchmarks.py --output new.json --baseline report.json
+
+With --baseline, metrics that got worse by more than --tolerance are listed
+as regressions and the exit status is 1.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from instrumentation import logger
+
+# Seed of every benchmark
+SEED = 42
+
+# Number of times every measurement is repeated; the fastest one counts
+REPEATS = 5
+
+# Replay memory capacities to benchmark
+REPLAY_CAPACITIES = (int(1e3), int(1e4), int(1e5))
+
+# Number of vehicles stepped at once by the vectorized simulator benchmark
+NUM_VECTOR_VEHICLES = 256
+
+# Hidden layer sizes of the benchmarked network, as model.HIDDEN_SIZES (which
+# cannot be imported without TensorFlow)
+HIDDEN_SIZES = [16, 16]
+
+# Modules whose cold import time is measured; none may import HEAVY_MODULES
+IMPORT_MODULES = ("vehicle", "play", "replay_memory", "experience_collector",
+                  "experience_batcher", "actors", "learning")
+
+# Modules that the simulation and collection path must not import
+HEAVY_MODULES = ("tensorflow", "matplotlib")
+
+# Relative change of import times at which compare() flags a regression;
+# process startup is noisier than the other benchmarks
+IMPORT_TOLERANCE = 0.5
+
+# Relative change at which compare() flags a regression
+REGRESSION_TOLERANCE = 0.1
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+def _best_time(function, number, repeats=REPEATS):
+  """Returns the fastest mean time in seconds of calling function() <number>
+  times, over <repeats> runs."""
+
+  best = float("inf")
+  for _ in range(repeats):
+    start = _clock()
+    for _ in range(number):
+      function()
+    best = min(best, (_clock() - start) / number)
+  return best
+
+
+def _rate(value, unit):
+  return {"value": value, "unit": unit, "higher_is_better": True}
+
+
+def _latency(seconds):
+  return {"value": seconds * 1e6, "unit": "us", "higher_is_better": False}
+
+
+def benchmark_simulator(scale=1.0):
+  """Measures the steps per second of the scalar and vectorized simulator.
+
+  Also reports the mean n-step window length of follow_batch() experiences
+  in a replay memory, which should be experience_batcher.N_STEP_RETURNS.
+  """
+
+  import vehicle
+  np.random.seed(SEED)
+  results = {}
+
+  num_steps = max(int(10000 * scale), 1)
+  actions = np.random.randint(vehicle.NUM_OF_ACTIONS, size=num_steps).tolist()
+  def scalar_steps():
+    controller = vehicle.Vehicle_Controller(
+        [0.0, 0.0, 0.0, 0.0], [1e3, 1e3, 0.0, 0.0], False,
+        clock=vehicle.SimulationClock())
+    for action in actions:
+      controller.do_action(action)
+  results["simulator.scalar_steps_per_second"] = _rate(
+      num_steps / _best_time(scalar_steps, 1), "steps/s")
+
+  num_steps = max(int(1000 * scale), 1)
+  controller = vehicle.VectorVehicleController(NUM_VECTOR_VEHICLES)
+  actions = np.random.randint(vehicle.NUM_OF_ACTIONS,
+                              size=(num_steps, NUM_VECTOR_VEHICLES))
+  def vector_steps():
+    for step_actions in actions:
+      controller.do_actions(step_actions)
+  results["simulator.vector_steps_per_second"] = _rate(
+      num_steps * NUM_VECTOR_VEHICLES / _best_time(vector_steps, 1),
+      "steps/s")
+
+  # Lockstep experiences must continue in the replay memory, or n-step
+  # targets silently fall back to one step.
+  import experience_batcher
+  import play
+  import replay_memory
+  n_steps = experience_batcher.N_STEP_RETURNS
+  controller = vehicle.VectorVehicleController(NUM_VECTOR_VEHICLES)
+  columns = play.follow_batch(
+      lambda states, _: np.random.randint(vehicle.NUM_OF_ACTIONS,
+                                          size=len(states)),
+      controller, n_steps)
+  memory = replay_memory.ReplayMemory(capacity=len(columns["actions"]))
+  memory.add_batch(**columns)
+  _, valid = memory.n_step_windows(np.arange(0, memory.size, n_steps),
+                                   n_steps)
+  window_steps = float(valid.sum(axis=1).mean())
+  if window_steps < n_steps:
+    logger.warning("follow_batch() windows last %.2f of %d steps",
+                   window_steps, n_steps)
+  results["simulator.lockstep_window_steps"] = _rate(window_steps, "steps")
+  return results
+
+
+def _random_columns(count, state_size, num_actions):
+  """Returns columns of <count> random experiences for add_batch()."""
+
+  return {
+      "states": np.random.rand(count, state_size).astype(np.float32),
+      "actions": np.random.randint(num_actions, size=count).astype(np.int32),
+      "rewards": np.random.rand(count).astype(np.float32),
+      "next_states": np.random.rand(count, state_size).astype(np.float32),
+      "game_over": np.random.rand(count) < 0.01,
+  }
+
+
+def benchmark_replay(capacities=REPLAY_CAPACITIES, scale=1.0, batch_size=32):
+  """Measures adding to and sampling from memories of several capacities."""
+
+  import play
+  import replay_memory
+  state_size = replay_memory.NUM_ELEMENTS_IN_STATE
+  num_actions = replay_memory.NUM_ACTIONS
+  results = {}
+  num_adds = max(int(1000 * scale), 1)
+  for capacity in capacities:
+    for name, memory_class in (("uniform", replay_memory.ReplayMemory),
+                               ("prioritized",
+                                replay_memory.PrioritizedReplayMemory)):
+      np.random.seed(SEED)
+      memory = memory_class(capacity=capacity)
+      memory.add_batch(**_random_columns(capacity, state_size, num_actions))
+      prefix = "replay.%s.%d." % (name, capacity)
+
+      experiences = [
+          play.Experience(np.random.rand(state_size), 0, 0.0,
+                          np.random.rand(state_size), False)
+          for _ in range(num_adds)]
+      def add():
+        for experience in experiences:
+          memory.add(experience)
+      results[prefix + "add_per_second"] = _rate(
+          num_adds / _best_time(add, 1), "experiences/s")
+
+      columns = _random_columns(play.STREAM_CHUNK_SIZE, state_size,
+                                num_actions)
+      results[prefix + "add_batch_per_second"] = _rate(
+          play.STREAM_CHUNK_SIZE /
+          _best_time(lambda: memory.add_batch(**columns), num_adds // 10 + 1),
+          "experiences/s")
+
+      results[prefix + "sample_latency"] = _latency(_best_time(
+          lambda: memory.get(memory.sample_indices(batch_size)), num_adds))
+  return results
+
+
+def _random_inference(state_size, num_actions):
+  """Returns a NumpyInference with random parameters."""
+
+  from inference import NumpyInference
+  sizes = [state_size] + HIDDEN_SIZES + [num_actions]
+  weights = [np.random.randn(n_in, n_out) * 0.1
+             for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+  biases = [np.zeros((n_out,)) for n_out in sizes[1:]]
+  return NumpyInference(weights, biases)
+
+
+def benchmark_batching(scale=1.0, batch_size=32):
+  """Measures the latency of building a batch and computing its targets."""
+
+  import experience_batcher
+  import play
+  import replay_memory
+  import target_batch_computer
+  np.random.seed(SEED)
+  state_size = replay_memory.NUM_ELEMENTS_IN_STATE
+  num_actions = replay_memory.NUM_ACTIONS
+  engine = _random_inference(state_size, num_actions)
+  batcher = experience_batcher.ExperienceBatcher(
+      None, engine.run_inference, engine.get_q_values, 1)
+  number = max(int(1000 * scale), 1)
+  results = {}
+
+  experiences = [
+      play.Experience(np.random.rand(state_size),
+                      np.random.randint(num_actions), 0.0,
+                      np.random.rand(state_size), np.random.rand() < 0.01)
+      for _ in range(batch_size)]
+  results["batching.experiences_to_batches_latency"] = _latency(_best_time(
+      lambda: batcher.experiences_to_batches(experiences), number))
+
+  batcher.memory.add_batch(**_random_columns(
+      batcher.memory.capacity, state_size, num_actions))
+  results["batching.sample_batches_latency"] = _latency(_best_time(
+      batcher.sample_batches, number))
+
+  computer = target_batch_computer.TargetBatchComputer(engine.run_inference)
+  rewards = np.random.rand(batch_size).astype(np.float32)
+  bad_actions = np.random.rand(batch_size) < 0.01
+  next_states = np.random.rand(batch_size, state_size).astype(np.float32)
+  available_actions = np.ones((batch_size, num_actions), dtype=bool)
+  merged = np.zeros((batch_size,), dtype=np.float32)
+  results["batching.target_compute_latency"] = _latency(_best_time(
+      lambda: computer.compute(rewards, bad_actions, next_states,
+                               available_actions, merged), number))
+  return results
+
+
+def benchmark_learner(scale=1.0, batch_size=32):
+  """Measures training steps per second. Skipped without TensorFlow."""
+
+  try:
+    import tensorflow as tf
+    from model import FeedModel
+  except ImportError:
+    logger.info("TensorFlow is not available, skipping the learner benchmark")
+    return {}
+
+  np.random.seed(SEED)
+  results = {}
+  with tf.Graph().as_default():
+    tf.set_random_seed(SEED)
+    model = FeedModel()
+    session = tf.Session(config=tf.ConfigProto(device_count={"GPU": 0}))
+    session.run(model.init)
+    state_size = model.state_batch_placeholder.get_shape()[1].value
+    feed_dict = {
+        model.state_batch_placeholder:
+            np.random.rand(batch_size, state_size).astype(np.float32),
+        model.targets_placeholder:
+            np.random.rand(batch_size).astype(np.float32),
+        model.actions_placeholder:
+            np.random.randint(model.q_values.get_shape()[1].value,
+                              size=batch_size).astype(np.int32),
+    }
+    number = max(int(1000 * scale), 1)
+    results["learner.steps_per_second"] = _rate(
+        1 / _best_time(lambda: session.run(model.train_op, feed_dict),
+                       number), "steps/s")
+    session.close()
+  return results
+
+
+_IMPORT_SCRIPT = """
+import sys, time
+clock = getattr(time, "perf_counter", time.time)
+start = clock()
+import %s
+seconds = clock() - start
+print(seconds, ",".join(name for name in %r if name in sys.modules))
+"""
+
+
+def benchmark_imports(modules=IMPORT_MODULES, scale=1.0):
+  """Measures the cold import time of modules in fresh interpreters.
+
+  Besides the time, reports for every module how many of HEAVY_MODULES its
+  import pulled in, which should stay 0.
+  """
+
+  del scale  # Every import is measured REPEATS times.
+  directory = os.path.dirname(os.path.abspath(__file__))
+  results = {}
+  for module in modules:
+    best = float("inf")
+    for _ in range(REPEATS):
+      output = subprocess.check_output(
+          [sys.executable, "-c", _IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+          cwd=directory).decode().split()
+      best = min(best, float(output[0]))
+    heavy = output[1].split(",") if len(output) > 1 else []
+    if heavy:
+      logger.warning("Importing %s loads %s", module, ", ".join(heavy))
+    results["imports.%s.seconds" % module] = {
+        "value": best, "unit": "s", "higher_is_better": False,
+        "tolerance": IMPORT_TOLERANCE}
+    results["imports.%s.heavy_modules" % module] = {
+        "value": len(heavy), "unit": "modules", "higher_is_better": False}
+  return results
+
+
+# All benchmarks, by name
+BENCHMARKS = {
+    "imports": benchmark_imports,
+    "simulator": benchmark_simulator,
+    "replay": benchmark_replay,
+    "batching": benchmark_batching,
+    "learner": benchmark_learner,
+}
+
+
+def run_benchmarks(names=None, scale=1.0):
+  """Runs the benchmarks with the given names (default all).
+
+  Returns:
+    The report, a dict with "metadata" about the machine and "results", a dict
+    metric name -> dict with value, unit, higher_is_better and optionally a
+    tolerance that overrides a smaller one passed to compare().
+  """
+
+  results = {}
+  for name in names or sorted(BENCHMARKS):
+    results.update(BENCHMARKS[name](scale=scale))
+  return {
+      "metadata": {
+          "python": platform.python_version(),
+          "numpy": np.__version__,
+          "machine": platform.machine(),
+          "processor": platform.processor(),
+          "seed": SEED,
+          "scale": scale,
+          "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+      },
+      "results": results,
+  }
+
+
+def compare(report, baseline, tolerance=REGRESSION_TOLERANCE):
+  """Compares the metrics of a report against a baseline report.
+
+  Returns:
+    A list of (name, baseline value, value, relative change) for all metrics
+    present in both reports, sorted by name, and a list of the names of the
+    metrics that got worse by more than <tolerance>. The relative change is
+    positive for improvements.
+  """
+
+  changes = []
+  regressions = []
+  for name in sorted(set(report["results"]) & set(baseline["results"])):
+    metric = report["results"][name]
+    old = baseline["results"][name]["value"]
+    new = metric["value"]
+    if old:
+      change = (new - old) / old
+    else:
+      # Any change from 0 (e.g. heavy_modules) counts as large.
+      change = 0.0 if new == old else float(np.sign(new)) * float("inf")
+    if not metric["higher_is_better"]:
+      change = -change
+    changes.append((name, old, new, change))
+    if change < -max(tolerance, metric.get("tolerance", 0.0)):
+      regressions.append(name)
+  return changes, regressions
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("benchmarks", nargs="*",
+                      help="benchmarks to run (%s), default all" %
+                      ", ".join(sorted(BENCHMARKS)))
+  parser.add_argument("--output", help="file the JSON report is written to")
+  parser.add_argument("--baseline", help="JSON report to compare against")
+  parser.add_argument("--tolerance", type=float,
+                      default=REGRESSION_TOLERANCE,
+                      help="relative change flagged as regression")
+  parser.add_argument("--scale", type=float, default=1.0,
+                      help="factor on the number of iterations")
+  options = parser.parse_args(args[1:])
+  for name in options.benchmarks:
+    if name not in BENCHMARKS:
+      parser.error("unknown benchmark: %s" % name)
+
+  report = run_benchmarks(options.benchmarks, options.scale)
+  if options.output:
+    with open(options.output, "w") as report_file:
+      json.dump(report, report_file, indent=2, sort_keys=True)
+
+  if not options.baseline:
+    for name, metric in sorted(report["results"].items()):
+      print("%-50s %14.2f %s" % (name, metric["value"], metric["unit"]))
+    return 0
+
+  with open(options.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+  changes, regressions = compare(report, baseline, options.tolerance)
+  for name, old, new, change in changes:
+    print("%-50s %14.2f -> %14.2f %+7.1f%%%s" %
+          (name, old, new, change * 100,
+           "  REGRESSION" if name in regressions else ""))
+  if regressions:
+    print("%d regression(s) beyond %.0f%%" %
+          (len(regressions), options.tolerance * 100))
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
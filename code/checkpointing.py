@@ -0,0 +1,220 @@
+"""Checkpoints that are written on a background thread."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+from instrumentation import logger, timers
+
+# Number of most recent checkpoints kept on disk
+CHECKPOINT_KEEP = 5
+
+# File name prefix of the checkpoints
+CHECKPOINT_PREFIX = "ckpt"
+
+# File that names the latest complete checkpoint
+LATEST_FILE = "latest.json"
+
+
+def _variable_key(variable):
+  """Returns the name a variable is stored under, e.g. "target/weights"."""
+
+  return re.sub(r":\d+$", "", variable.name)
+
+
+class AsyncCheckpointer(object):
+  """Saves TensorFlow variables and training state without stalling training.
+
+  save() only copies the variables to numpy arrays with one session.run();
+  a background thread writes them to <directory>/ckpt-<step>.npz together
+  with a JSON file of further training state, then updates LATEST_FILE and
+  deletes all but the last <keep> checkpoints. Pass all global variables to
+  include the global step and the optimizer slots. If the thread is still
+  writing when the next checkpoint is saved, only the newest pending one is
+  written.
+  """
+
+  def __init__(self, directory, variables, keep=CHECKPOINT_KEEP):
+    """Init AsyncCheckpointer and start the writer thread.
+
+    Args:
+      directory: Directory of the checkpoints.
+      variables: List of the tf.Variables to save and restore.
+      keep: Number of checkpoints kept.
+    """
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.variables = list(variables)
+    self.keep = keep
+    self._condition = threading.Condition()
+    self._pending = None
+    self._writing = False
+    self._stopped = False
+    self._error = None
+    self.written = 0
+    self.skipped = 0
+
+    self._thread = threading.Thread(target=self._write_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def save(self, session, step, state=None, memory=None):
+    """Snapshots the variables and queues them for writing.
+
+    Args:
+      session: The tf.Session holding the variables.
+      step: The global step, used in the file name.
+      state: Optional JSON-serializable dict of further training state, e.g.
+          the position in the epsilon schedule.
+      memory: Optional ReplayMemory, snapshotted as of this call.
+    """
+
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+    with timers.timer("checkpoint_snapshot"):
+      values = session.run(self.variables)
+      memory_metadata = memory.metadata() if memory is not None else None
+    with self._condition:
+      if self._pending is not None:
+        self.skipped += 1
+      self._pending = (int(step), values, dict(state or {}), memory,
+                       memory_metadata)
+      self._condition.notify()
+
+
+  def _write_loop(self):
+    """Writer thread: writes pending checkpoints until stopped."""
+
+    while True:
+      with self._condition:
+        while self._pending is None and not self._stopped:
+          self._condition.wait()
+        if self._pending is None:
+          return
+        pending, self._pending = self._pending, None
+        self._writing = True
+      try:
+        with timers.timer("checkpoint_write"):
+          self._write(*pending)
+        self.written += 1
+      except Exception as error:  # pylint: disable=broad-except
+        logger.error("Writing checkpoint %d failed: %s", pending[0], error)
+        self._error = error
+      finally:
+        with self._condition:
+          self._writing = False
+          self._condition.notify_all()
+
+
+  def _path(self, step, extension):
+    return os.path.join(self.directory,
+                        "%s-%d.%s" % (CHECKPOINT_PREFIX, step, extension))
+
+
+  def _write(self, step, values, state, memory, memory_metadata):
+    """Writes one checkpoint, then rotates the old ones."""
+
+    if memory is not None:
+      memory.snapshot(memory_metadata)
+    arrays = {_variable_key(variable): value
+              for variable, value in zip(self.variables, values)}
+    # np.savez appends .npz to names without it.
+    temp_path = self._path(step, "tmp.npz")
+    np.savez(temp_path, **arrays)
+    os.rename(temp_path, self._path(step, "npz"))
+    state = dict(state, step=step)
+    self._write_json(self._path(step, "json"), state)
+    self._write_json(os.path.join(self.directory, LATEST_FILE),
+                     {"step": step})
+    logger.info("Checkpoint %d written", step)
+
+    for old_step in self.steps()[:-self.keep]:
+      for extension in ("npz", "json"):
+        if os.path.exists(self._path(old_step, extension)):
+          os.remove(self._path(old_step, extension))
+
+
+  @staticmethod
+  def _write_json(path, data):
+    """Atomically replaces the JSON file at path."""
+
+    with open(path + ".tmp", "w") as json_file:
+      json.dump(data, json_file)
+    os.rename(path + ".tmp", path)
+
+
+  def steps(self):
+    """Returns the sorted steps of the checkpoints on disk."""
+
+    pattern = os.path.join(self.directory, CHECKPOINT_PREFIX + "-*.npz")
+    steps = []
+    for path in glob.glob(pattern):
+      match = re.search(r"-(\d+)\.npz$", path)
+      if match:
+        steps.append(int(match.group(1)))
+    return sorted(steps)
+
+
+  def latest_step(self):
+    """Returns the step of the latest complete checkpoint, or None."""
+
+    latest_path = os.path.join(self.directory, LATEST_FILE)
+    if not os.path.exists(latest_path):
+      return None
+    with open(latest_path) as latest_file:
+      return json.load(latest_file)["step"]
+
+
+  def restore(self, session, step=None):
+    """Loads the variables of a checkpoint (default the latest).
+
+    Variables missing from the checkpoint keep their values.
+
+    Returns:
+      The training state dict passed to save() with its "step", or None if
+      there is no checkpoint.
+    """
+
+    if step is None:
+      step = self.latest_step()
+      if step is None:
+        return None
+    with np.load(self._path(step, "npz")) as arrays:
+      for variable in self.variables:
+        key = _variable_key(variable)
+        if key in arrays.files:
+          variable.load(arrays[key], session)
+        else:
+          logger.warning("Checkpoint %d has no value for %s", step, key)
+    with open(self._path(step, "json")) as state_file:
+      state = json.load(state_file)
+    logger.info("Restored checkpoint %d", step)
+    return state
+
+
+  def wait(self):
+    """Blocks until all queued checkpoints are written."""
+
+    with self._condition:
+      while self._pending is not None or self._writing:
+        self._condition.wait()
+
+
+  def stop(self):
+    """Writes the queued checkpoints and stops the writer thread."""
+
+    with self._condition:
+      self._stopped = True
+      self._condition.notify_all()
+    self._thread.join()
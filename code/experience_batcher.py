@@ -7,65 +7,106 @@ from __future__ import print_function
 import numpy as np
 import itertools
 
+from instrumentation import logger, timers
 import play
+import planner
 import replay_memory
 import target_batch_computer
 
 
 BATCH_SIZE = 32
 
-# Number of batches for which the model is kept constant
-BATCHES_KEEP_CONSTANT = 1e3
-
 # Parameters for epsilon (for epsilon-greedy play)
 START_DECREASE_EPSILON_GAMES = 200000
 DECREASE_EPSILON_GAMES = 100000.0
 MIN_EPSILON = 1.0
 
+# Whether to sample experiences proportional to their TD error
+PRIORITIZED_REPLAY = False
+
+# Number of planner games played into an empty memory before random games
+DEMONSTRATION_GAMES = 0
+
+# Number of rewards summed into the targets of memory batches before the
+# Q-Value is bootstrapped (1: one-step targets)
+N_STEP_RETURNS = 3
+
 
 class ExperienceBatcher(object):
   """Builds experience batches using an ExperienceCollector."""
 
   def __init__(self, experience_collector, run_inference, get_q_values,
-               state_normalize_factor):
+               state_normalize_factor, memory_dir=None, actor_pool=None,
+               num_buffer_sets=1):
+    """Init ExperienceBatcher.
+
+    Args:
+      experience_collector: ExperienceCollector used to play games.
+      run_inference: function (state batch) -> estimated Q-Values, used for
+          the targets. Should query the target network, so that the targets
+          stay constant between syncs.
+      get_q_values: function (state) -> estimated Q-Values.
+      state_normalize_factor: Factor the states are multiplied with.
+      memory_dir: Optional directory for a memory-mapped replay memory. If it
+          holds a snapshot, the memory is reopened instead of refilled.
+      actor_pool: Optional ActorPool. If given, games are played by its actor
+          processes instead of the experience_collector, and one batch is
+          yielded per epsilon step.
+      num_buffer_sets: Number of BatchBuffers that batches are built in, in
+          turn. A batch stays valid until num_buffer_sets more batches have
+          been built, so consumers that hold several batches at once (e.g. a
+          BatchPrefetcher) need more than one.
+    """
 
     self.experience_collector = experience_collector
     self.run_inference = run_inference
     self.get_q_values = get_q_values
     self.state_normalize_factor = state_normalize_factor
-
-
-  def get_batches_stepwise(self):
-    """Wraps get_batches(), keeping the current predictions constant for
-    BATCHES_KEEP_CONSTANT steps.
-    """
-
-    cache = []
-
-    for batches in self.get_batches():
-      cache.append(batches)
-
-      if len(cache) >= BATCHES_KEEP_CONSTANT:
-        for cached_batches in cache:
-          yield cached_batches
-        cache = []
+    self.actor_pool = actor_pool
+    if PRIORITIZED_REPLAY:
+      self.memory = replay_memory.PrioritizedReplayMemory(
+          directory=memory_dir)
+    else:
+      self.memory = replay_memory.ReplayMemory(directory=memory_dir)
+    self.target_batch_computer = target_batch_computer.TargetBatchComputer(
+        run_inference)
+    self.num_buffer_sets = num_buffer_sets
+    # Position in the epsilon schedule, saved with checkpoints.
+    self.epsilon_step = 0
+    self._buffers = []
+    self._next_buffers = 0
 
 
   def get_batches(self):
     """Yields randomized batches epsilon-greedy games.
 
-    Maintains a replay memory at full capacity.
+    Maintains a replay memory at full capacity. Every batch is a tuple
+    state_batch, targets, actions, importance_weights, indices where indices
+    are the memory indices of the experiences, to update their priorities
+    through self.memory.update_priorities().
     """
 
-    print("Initializing memory...")
-    memory = replay_memory.ReplayMemory()
+    memory = self.memory
+    if not memory.is_full():
+      logger.info("Initializing memory...")
+    if DEMONSTRATION_GAMES and not len(memory):
+      demonstrations = self.experience_collector.collect_demonstrations(
+          planner.LookaheadPlanner(), DEMONSTRATION_GAMES)
+      memory.add_batch(**play.experiences_to_columns(demonstrations))
     while not memory.is_full():
-      for experience in self.experience_collector.collect(play.random_strategy):
-        memory.add(experience)
+      if self.actor_pool is not None:
+        self.actor_pool.drain(memory, block=True)
+        continue
+      for experiences in self.experience_collector.collect_stream(
+          play.random_strategy):
+        memory.add_batch(**play.experiences_to_columns(experiences))
+        if memory.is_full():
+          break
 
     memory.print_stats()
 
-    for i in itertools.count():
+    for i in itertools.count(self.epsilon_step):
+      self.epsilon_step = i
       if i < START_DECREASE_EPSILON_GAMES:
         epsilon = 1.0
       else:
@@ -73,40 +114,198 @@ class ExperienceBatcher(object):
                       1.0 - (i - START_DECREASE_EPSILON_GAMES) /
                       DECREASE_EPSILON_GAMES)
 
+      if self.actor_pool is not None:
+        self.actor_pool.set_epsilon(epsilon)
+        with timers.timer("replay_add"):
+          self.actor_pool.drain(memory)
+        yield self.sample_batches()
+        continue
+
       strategy = play.make_epsilon_greedy_strategy(self.get_q_values, epsilon)
 
-      for experience in self.experience_collector.collect(strategy):
-        memory.add(experience)
-        batch_experiences = memory.sample(BATCH_SIZE)
-        yield self.experiences_to_batches(batch_experiences)
+      # Experiences stream into the memory while the game is played, with one
+      # batch per added experience.
+      for experiences in self.experience_collector.collect_stream(strategy):
+        with timers.timer("replay_add"):
+          memory.add_batch(**play.experiences_to_columns(experiences))
+        for _ in experiences:
+          yield self.sample_batches()
+
+
+  def get_offline_batches(self, reader, chunk_size=play.STREAM_CHUNK_SIZE):
+    """Yields batches like get_batches(), from recorded games instead of
+    played ones.
+
+    The recording is streamed into the memory chunk by chunk, with one batch
+    per added experience once the memory is full. After the end of the
+    recording, batches keep being sampled from the memory.
+
+    Args:
+      reader: trajectory_store.TrajectoryReader of the recording.
+      chunk_size: Number of experiences read from disk at once.
+    """
+
+    memory = self.memory
+    for columns in reader.iter_chunks(chunk_size):
+      with timers.timer("replay_add"):
+        memory.add_batch(**columns)
+      if memory.is_full():
+        for _ in range(len(columns["actions"])):
+          yield self.sample_batches()
+
+    memory.print_stats()
+    while True:
+      yield self.sample_batches()
+
+
+  def sample_batches(self):
+    """Samples BATCH_SIZE experiences from memory and returns state_batch,
+    targets, actions, importance_weights, indices."""
+
+    with timers.timer("replay_sample"):
+      indices = self.memory.sample_indices(BATCH_SIZE)
+      importance_weights = self.memory.importance_weights(indices)
+    state_batch, targets, actions = self.indices_to_batches(indices)
+    return state_batch, targets, actions, importance_weights, indices
+
+
+  def _get_buffers(self, batch_size):
+    """Returns the next BatchBuffers for <batch_size>, allocating them once."""
+
+    if not self._buffers or self._buffers[0].batch_size != batch_size:
+      self._buffers = [BatchBuffers(batch_size,
+                                    self.memory.states.shape[1],
+                                    self.memory.available_actions.shape[1])
+                       for _ in range(self.num_buffer_sets)]
+    buffers = self._buffers[self._next_buffers % len(self._buffers)]
+    self._next_buffers += 1
+    return buffers
+
+
+  def indices_to_batches(self, indices):
+    """Computes state_batch, targets, actions for the memory experiences at
+    <indices>.
+
+    The batch is gathered from the memory columns into reused buffers, so the
+    returned arrays are only valid until num_buffer_sets more batches are
+    built.
+    """
+
+    memory = self.memory
+    buffers = self._get_buffers(len(indices))
+    with timers.timer("batch_build"):
+      self._gather(memory, indices, buffers)
+    return self._compute_batches(buffers)
+
+
+  def _gather(self, memory, indices, buffers):
+    """Copies the memory rows at <indices> into buffers.
+
+    With N_STEP_RETURNS > 1, the rewards are the discounted returns of the
+    windows from memory.n_step_windows(), and the next state, game end and
+    available actions are those of the last experience of each window. Its
+    Q-Value is bootstrapped unless the game ended there; a truncated game is
+    bootstrapped like a one-step target.
+    """
+
+    np.take(memory.states, indices, axis=0, out=buffers.state_batch)
+    np.take(memory.actions, indices, out=buffers.actions)
+    if N_STEP_RETURNS > 1:
+      rows, valid = memory.n_step_windows(indices, N_STEP_RETURNS)
+      returns, num_steps, discounts = target_batch_computer.n_step_returns(
+          memory.rewards[rows], valid)
+      buffers.reward_batch[:] = returns
+      buffers.discounts[:] = discounts
+      indices = rows[np.arange(len(indices)), num_steps - 1]
+    else:
+      np.take(memory.rewards, indices, out=buffers.reward_batch)
+      buffers.discounts[:] = target_batch_computer.GAMMA
+    np.take(memory.next_states, indices, axis=0, out=buffers.next_state_batch)
+    np.take(memory.game_over, indices, out=buffers.bad_action_batch)
+    np.take(memory.not_available, indices, out=buffers.not_available_batch)
+    np.logical_or(buffers.bad_action_batch, buffers.not_available_batch,
+                  out=buffers.bad_action_batch)
+    np.take(memory.available_actions, indices, axis=0,
+            out=buffers.available_actions_batch)
+
+
+  def memory_to_batches(self, memory, indices):
+    """Computes state_batch, targets, actions for the experiences at
+    <indices> of another memory, e.g. one of held-out test experiences.
+
+    The targets are built like those of indices_to_batches(), including
+    N_STEP_RETURNS. The batch is built in new buffers, so it stays valid and
+    does not disturb the buffers of batches being prefetched.
+    """
+
+    buffers = BatchBuffers(len(indices), memory.states.shape[1],
+                           memory.available_actions.shape[1])
+    self._gather(memory, indices, buffers)
+    return self._compute_batches(buffers)
 
 
   def experiences_to_batches(self, experiences):
-    """Computes state_batch, targets, actions."""
+    """Computes state_batch, targets, actions for a list of Experiences.
 
-    batch_size = len(experiences)
-    state_batch = np.zeros((batch_size, 16), dtype=np.float)
-    next_state_batch = np.zeros((batch_size, 16), dtype=np.float)
-    actions = np.zeros((batch_size,), dtype=np.int)
-    reward_batch = np.zeros((batch_size,), dtype=np.float)
-    bad_action_batch = np.zeros((batch_size,), dtype=np.bool)
-    available_actions_batch = np.zeros((batch_size, 4), dtype=np.bool)
-    merged = np.zeros((batch_size,), dtype=np.float)
+    Like indices_to_batches(), the returned arrays are reused buffers. The
+    experiences are not known to be consecutive, so the targets are one-step
+    targets regardless of N_STEP_RETURNS; see memory_to_batches() for n-step
+    targets.
+    """
 
+    buffers = self._get_buffers(len(experiences))
+    buffers.state_batch[:] = [np.ravel(e.state) for e in experiences]
+    buffers.next_state_batch[:] = [np.ravel(e.next_state)
+                                   for e in experiences]
+    buffers.actions[:] = [e.action for e in experiences]
+    buffers.reward_batch[:] = [e.reward for e in experiences]
+    buffers.discounts[:] = target_batch_computer.GAMMA
+    buffers.bad_action_batch[:] = [e.game_over or e.not_available
+                                   for e in experiences]
+    buffers.available_actions_batch[:] = True
     for i, experience in enumerate(experiences):
-      state_batch[i, :] = (experience.state.flatten() *
-                           self.state_normalize_factor)
-      next_state_batch[i, :] = (experience.next_state.flatten() *
-                                self.state_normalize_factor)
-      actions[i] = experience.action
-      reward_batch[i] = experience.reward
-      bad_action_batch[i] = experience.game_over or experience.not_available
-      available_actions_batch[i, experience.next_state_available_actions] = True
-      merged[i] = (np.count_nonzero(experience.state) -
-                   np.count_nonzero(experience.next_state) + 1)
-
-    targets = target_batch_computer.TargetBatchComputer(self.run_inference).compute(
-        reward_batch, bad_action_batch, next_state_batch,
-        available_actions_batch, merged)
-
-    return state_batch, targets, actions
+      if experience.next_state_available_actions is not None:
+        buffers.available_actions_batch[i] = False
+        buffers.available_actions_batch[
+            i, experience.next_state_available_actions] = True
+    return self._compute_batches(buffers)
+
+
+  def _compute_batches(self, buffers):
+    """Normalizes the gathered states and computes the targets."""
+
+    buffers.merged[:] = (np.count_nonzero(buffers.state_batch, axis=1) -
+                         np.count_nonzero(buffers.next_state_batch, axis=1) +
+                         1)
+    buffers.state_batch *= self.state_normalize_factor
+    buffers.next_state_batch *= self.state_normalize_factor
+
+    with timers.timer("target_inference"):
+      targets = self.target_batch_computer.compute(
+          buffers.reward_batch, buffers.bad_action_batch,
+          buffers.next_state_batch, buffers.available_actions_batch,
+          buffers.merged, buffers.discounts)
+
+    return buffers.state_batch, targets, buffers.actions
+
+
+class BatchBuffers(object):
+  """Preallocated arrays that a batch is assembled in.
+
+  Using float32 and int32 lets TensorFlow consume the batches without
+  conversion.
+  """
+
+  def __init__(self, batch_size, state_size, num_actions):
+    self.batch_size = batch_size
+    self.state_batch = np.zeros((batch_size, state_size), dtype=np.float32)
+    self.next_state_batch = np.zeros((batch_size, state_size),
+                                     dtype=np.float32)
+    self.actions = np.zeros((batch_size,), dtype=np.int32)
+    self.reward_batch = np.zeros((batch_size,), dtype=np.float32)
+    self.bad_action_batch = np.zeros((batch_size,), dtype=bool)
+    self.not_available_batch = np.zeros((batch_size,), dtype=bool)
+    self.available_actions_batch = np.zeros((batch_size, num_actions),
+                                            dtype=bool)
+    self.merged = np.zeros((batch_size,), dtype=np.float32)
+    self.discounts = np.zeros((batch_size,), dtype=np.float32)
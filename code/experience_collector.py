@@ -4,9 +4,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import numpy as np
 import math
-from play import Follow
+from instrumentation import timers
+from play import EpisodeScheduler, Follow, STREAM_CHUNK_SIZE, follow_stream
+from play import experiences_to_columns, make_planner_strategy, random_episode
 import vehicle
 
 # Parameters for undersampling
@@ -14,9 +17,111 @@ DO_UNDERSAMPLING = False
 AVG_KEEP_PROB = 0.04
 MIN_KEEP_PROB = 0.01
 
+# Game length assumed for undersampling streamed games without max_steps
+UNDERSAMPLING_HORIZON = 1000
+
+# Parameters for deduplication: states are compared on a grid with cells of
+# DEDUP_RESOLUTION (meters for x, y and radians for the angles) and at most
+# DEDUP_MAX_ENTRIES recently seen cells are remembered.
+DEDUP_RESOLUTION = 1e-2
+DEDUP_MAX_ENTRIES = int(1e6)
+
+
+class DeduplicationIndex(object):
+  """Remembers quantized states across episodes to filter duplicates.
+
+  States are snapped to a grid of the given resolution, so nearly identical
+  continuous poses count as duplicates, and a whole episode is hashed with a
+  few array operations. The index evicts the least recently seen cells once
+  it holds more than max_entries, so its memory stays bounded. Distinct
+  cells can collide in the 64 bit hash; such rare collisions only drop a
+  novel state.
+  """
+
+  def __init__(self, resolution=DEDUP_RESOLUTION,
+               max_entries=DEDUP_MAX_ENTRIES):
+    """Init DeduplicationIndex.
+
+    Args:
+      resolution: Grid cell size, a scalar or one value per state element.
+      max_entries: Maximum number of remembered cells.
+    """
+    self.resolution = np.asarray(resolution, dtype=np.float64)
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self.lookups = 0
+    self.hits = 0
+
+
+  def __len__(self):
+    return len(self._entries)
+
+
+  def keys(self, states):
+    """Returns a (N,) uint64 array with the hash keys of (N, size) states."""
+
+    return vehicle.quantized_keys(states, self.resolution)
+
+
+  def filter(self, states):
+    """Returns a (N,) bool array, True for states not seen before.
+
+    Of several states in the same cell, only the first one counts as new.
+    All states are remembered as seen.
+    """
+
+    keys = self.keys(states)
+    unique_keys, first_indices = np.unique(keys, return_index=True)
+    novel = np.zeros((len(keys),), dtype=bool)
+    entries = self._entries
+    for key, index in zip(unique_keys.tolist(), first_indices.tolist()):
+      if key in entries:
+        entries.move_to_end(key)
+      else:
+        entries[key] = None
+        novel[index] = True
+    while len(entries) > self.max_entries:
+      entries.popitem(last=False)
+
+    hits = len(keys) - np.count_nonzero(novel)
+    self.lookups += len(keys)
+    self.hits += hits
+    timers.count("dedup_lookups", len(keys))
+    timers.count("dedup_hits", hits)
+    return novel
+
+
+  def hit_rate(self):
+    """Returns the fraction of looked up states that were duplicates."""
+
+    return self.hits / max(self.lookups, 1)
+
+
 class ExperienceCollector(object):
   """Collects experiences by following according to a particular strategy."""
 
+  def __init__(self, dedup_index=None, recorder=None):
+    """Init ExperienceCollector.
+
+    Args:
+      dedup_index: DeduplicationIndex shared by all collected games. Defaults
+          to a new index.
+      recorder: Optional trajectory_store.TrajectoryWriter that records the
+          complete games, before deduplication and undersampling.
+    """
+    if dedup_index is None:
+      dedup_index = DeduplicationIndex()
+    self.dedup_index = dedup_index
+    self.recorder = recorder
+
+
+  def record(self, experiences):
+    """Passes played experiences to the recorder, if there is one."""
+
+    if self.recorder is not None and experiences:
+      with timers.timer("record"):
+        self.recorder.append(experiences_to_columns(experiences))
+
 
   def get_keep_probability(self, index, length):
     """Computes the keep probability for the experience with a given index.
@@ -42,16 +147,16 @@ class ExperienceCollector(object):
 
 
   def deduplicate(self, experiences):
-    """Returns a new experience array that contains contains no duplicates."""
+    """Returns a new experience array that contains no states seen before,
+    in this or an earlier game."""
 
-    state_set = set()
-    filterted_experiences = []
-    for experience in experiences:
-      state_tuple = tuple(experience.state.flatten())
-      if not state_tuple in state_set:
-        state_set.add(state_tuple)
-        filterted_experiences.append(experience)
-    return filterted_experiences
+    if not experiences:
+      return []
+    states = np.array([np.ravel(experience.state)
+                       for experience in experiences])
+    novel = self.dedup_index.filter(states)
+    return [experience for experience, is_novel in zip(experiences, novel)
+            if is_novel]
 
 
   def collect(self, strategy, num_games=1):
@@ -60,9 +165,11 @@ class ExperienceCollector(object):
     experiences = []
     for _ in range(num_games):
       # playing the game returns experiences
-      _, new_experiences = Follow(strategy)
+      new_experiences = Follow(strategy)
+      self.record(new_experiences)
       # filtered experiences
-      deduplicated_experiences = self.deduplicate(new_experiences)
+      with timers.timer("deduplicate"):
+        deduplicated_experiences = self.deduplicate(new_experiences)
       # count the filtered experiences
       count = len(deduplicated_experiences)
       #
@@ -70,3 +177,57 @@ class ExperienceCollector(object):
                       if (np.random.rand() <
                           self.get_keep_probability(index, count))]
     return experiences
+
+
+  def collect_stream(self, strategy, num_games=1, chunk_size=STREAM_CHUNK_SIZE,
+                     max_steps=None):
+    """Plays num_games games like collect(), but yields the experiences in
+    chunks while the games are played.
+
+    Deduplication and undersampling are applied chunk by chunk. As the length
+    of a game is not known before it ends, undersampling assumes games of
+    max_steps (or UNDERSAMPLING_HORIZON) experiences.
+
+    Yields:
+      Non-empty lists of at most chunk_size experiences.
+    """
+
+    length = max_steps if max_steps is not None else UNDERSAMPLING_HORIZON
+    for _ in range(num_games):
+      index = 0
+      for chunk in follow_stream(strategy, chunk_size, max_steps=max_steps):
+        self.record(chunk)
+        with timers.timer("deduplicate"):
+          chunk = self.deduplicate(chunk)
+        kept = []
+        for experience in chunk:
+          if (np.random.rand() <
+              self.get_keep_probability(min(index, length - 1), length)):
+            kept.append(experience)
+          index += 1
+        if kept:
+          yield kept
+
+
+  def collect_demonstrations(self, planner, num_games=1, scheduler=None):
+    """Plays num_games games with a LookaheadPlanner, e.g. to warm-start the
+    replay memory with goal-reaching experiences.
+
+    Args:
+      planner: The LookaheadPlanner.
+      num_games: Number of games.
+      scheduler: EpisodeScheduler of the games. Defaults to random targets.
+
+    Returns:
+      The deduplicated experiences.
+    """
+
+    if scheduler is None:
+      scheduler = EpisodeScheduler(episode_source=random_episode)
+    strategy = make_planner_strategy(planner, scheduler)
+    experiences = []
+    for _ in range(num_games):
+      new_experiences = Follow(strategy, scheduler=scheduler)
+      self.record(new_experiences)
+      experiences += self.deduplicate(new_experiences)
+    return experiences
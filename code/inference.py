@@ -0,0 +1,121 @@
+"""Numpy inference engine for the Q-Value network."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+
+class NumpyInference(object):
+  """Evaluates the Q-Values of the model from a numpy copy of its parameters.
+
+  The network is small (see model.HIDDEN_SIZES), so for single states and
+  small batches the fixed cost of a session.run() call dominates the actual
+  math. This engine keeps a snapshot of the weights and biases that
+  model.build_inference_graph() creates and evaluates the same MLP (ReLU
+  hidden layers, linear output layer) in numpy. The snapshot is refreshed
+  with sync(), e.g. every few training steps.
+  """
+
+  def __init__(self, weights=None, biases=None):
+    """Init NumpyInference.
+
+    Args:
+      weights: Optional list of [input_size, layer_size] numpy arrays.
+      biases: Optional list of [layer_size] numpy arrays.
+    """
+    self._layers = []
+    self.version = 0
+    if weights is not None:
+      self.set_parameters(weights, biases)
+
+
+  def set_parameters(self, weights, biases):
+    """Replaces the parameters with the given weights and biases."""
+
+    # Replaced as a whole, so concurrent inference sees old or new parameters.
+    self._layers = [(np.asarray(weights_i, dtype=np.float32),
+                     np.asarray(biases_i, dtype=np.float32))
+                    for weights_i, biases_i in zip(weights, biases)]
+    self.version += 1
+
+
+  def parameters(self):
+    """Returns the parameters as one list, the weights followed by biases."""
+
+    layers = self._layers
+    return [w for w, _ in layers] + [b for _, b in layers]
+
+
+  def sync(self, session, model, target=False):
+    """Copies the parameters of a FeedModel.
+
+    Args:
+      session: The tf.Session holding the model's variables.
+      model: A FeedModel.
+      target: If set, copies the target network instead.
+    """
+
+    if target:
+      weights, biases = model.target_weights, model.target_biases
+    else:
+      weights, biases = model.weights, model.biases
+    parameters = session.run(weights + biases)
+    self.set_parameters(parameters[:len(weights)], parameters[len(weights):])
+
+
+  def run_inference(self, state_batch):
+    """Run inference on a given state_batch. Returns a q value batch."""
+
+    layers = self._layers
+    output = np.asarray(state_batch, dtype=np.float32)
+    for weights, biases in layers[:-1]:
+      output = np.dot(output, weights)
+      output += biases
+      np.maximum(output, 0, out=output)
+    weights, biases = layers[-1]
+    return np.dot(output, weights) + biases
+
+
+  def get_q_values(self, state):
+    """Run inference on a single state. Returns its Q-Values."""
+
+    return self.run_inference(np.reshape(state, (1, -1)))[0]
+
+
+def benchmark_latency(session, model, num_calls=1000, batch_size=1):
+  """Compares the per-call latency of session.run() and NumpyInference.
+
+  Args:
+    session: The tf.Session holding the model's variables.
+    model: A FeedModel.
+    num_calls: Number of inference calls per path.
+    batch_size: Number of states per call.
+
+  Returns:
+    A dict with the mean latency in microseconds of both paths and the
+    speedup of the numpy path.
+  """
+
+  state_batch = np.random.rand(
+      batch_size, model.state_batch_placeholder.get_shape()[1].value).astype(
+          np.float32)
+  engine = NumpyInference()
+  engine.sync(session, model)
+
+  start = time.time()
+  for _ in range(num_calls):
+    session.run(model.q_values,
+                feed_dict={model.state_batch_placeholder: state_batch})
+  session_us = (time.time() - start) / num_calls * 1e6
+
+  start = time.time()
+  for _ in range(num_calls):
+    engine.run_inference(state_batch)
+  numpy_us = (time.time() - start) / num_calls * 1e6
+
+  return {"batch_size": batch_size, "session_us": session_us,
+          "numpy_us": numpy_us, "speedup": session_us / numpy_us}
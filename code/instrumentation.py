@@ -0,0 +1,251 @@
+"""Logging, phase timers and profiling for the training loop."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import cProfile
+import logging
+import pstats
+import signal
+import threading
+import time
+
+import numpy as np
+
+# Number of most recent durations per phase used for percentiles
+TIMER_WINDOW = 10000
+
+# Seconds between two reports of maybe_report()
+REPORT_SECONDS = 60.0
+
+# Seconds disable_profiler() waits for worker threads to stop profiling
+PROFILER_STOP_SECONDS = 2.0
+
+_clock = getattr(time, "perf_counter", time.time)
+
+logger = logging.getLogger("vehicle_rl")
+if not logger.handlers:
+  _handler = logging.StreamHandler()
+  _handler.setFormatter(
+      logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+  logger.addHandler(_handler)
+# Per-step messages are logged with DEBUG and are off by default.
+logger.setLevel(logging.INFO)
+
+
+def set_log_level(level):
+  """Sets the log level, e.g. logging.DEBUG to see every simulation step."""
+  logger.setLevel(level)
+
+
+class PhaseTimers(object):
+  """Collects durations and counters of the phases of the training loop.
+
+  Recording a duration costs one clock read and one array write, so timers
+  can stay enabled in the hot path. For every phase, the last TIMER_WINDOW
+  durations are kept for latency percentiles. Phases are recorded from the
+  prefetch and writer threads too, so all access holds a lock.
+  """
+
+  def __init__(self, window=TIMER_WINDOW):
+    self.window = window
+    self._lock = threading.Lock()
+    self._durations = {}
+    self._counts = {}
+    self._counters = {}
+    self._reported_counts = {}
+    self._last_report_time = _clock()
+
+
+  def record(self, phase, seconds):
+    """Records that <phase> took <seconds>."""
+
+    with self._lock:
+      durations = self._durations.get(phase)
+      if durations is None:
+        durations = self._durations[phase] = np.zeros((self.window,))
+        self._counts[phase] = 0
+      count = self._counts[phase]
+      durations[count % self.window] = seconds
+      self._counts[phase] = count + 1
+
+
+  @contextlib.contextmanager
+  def timer(self, phase):
+    """Context manager that records the duration of its block as <phase>."""
+
+    start = _clock()
+    try:
+      yield
+    finally:
+      self.record(phase, _clock() - start)
+
+
+  def count(self, counter, value=1):
+    """Increments <counter> by <value>."""
+
+    with self._lock:
+      self._counters[counter] = self._counters.get(counter, 0) + value
+
+
+  def counters(self):
+    """Returns a copy of all counters."""
+
+    with self._lock:
+      return dict(self._counters)
+
+
+  def report(self):
+    """Returns phase statistics since the last report.
+
+    Returns:
+      A dict phase -> dict with the number of calls, calls per second since
+      the last report and mean, p50, p90 and p99 latencies in milliseconds
+      over the window.
+    """
+
+    with self._lock:
+      now = _clock()
+      elapsed = max(now - self._last_report_time, 1e-8)
+      stats = {}
+      for phase, durations in self._durations.items():
+        count = self._counts[phase]
+        recent = durations[:min(count, self.window)] * 1e3
+        p50, p90, p99 = np.percentile(recent, [50, 90, 99])
+        stats[phase] = {
+            "count": count,
+            "per_second": (count - self._reported_counts.get(phase, 0)) /
+                          elapsed,
+            "mean_ms": recent.mean(),
+            "p50_ms": p50,
+            "p90_ms": p90,
+            "p99_ms": p99,
+        }
+        self._reported_counts[phase] = count
+      self._last_report_time = now
+    return stats
+
+
+  def log_report(self):
+    """Logs report() and the counters."""
+
+    for phase, stats in sorted(self.report().items()):
+      logger.info("%-16s %8.1f/s  mean %.3fms  p50 %.3fms  p90 %.3fms  "
+                  "p99 %.3fms", phase, stats["per_second"], stats["mean_ms"],
+                  stats["p50_ms"], stats["p90_ms"], stats["p99_ms"])
+    for counter, value in sorted(self.counters().items()):
+      logger.info("%-16s %d", counter, value)
+
+
+  def maybe_report(self, interval=REPORT_SECONDS):
+    """Calls log_report() if <interval> seconds passed since the last one."""
+
+    if _clock() - self._last_report_time >= interval:
+      self.log_report()
+
+
+# Timers shared by all modules
+timers = PhaseTimers()
+
+
+_profiler = None
+
+# Guards the profilers of the worker threads
+_profiler_condition = threading.Condition()
+
+# Profilers of worker threads that are running and that have stopped
+_thread_profilers = []
+_stopped_thread_profilers = []
+
+_thread_state = threading.local()
+
+
+def enable_profiler():
+  """Starts profiling with cProfile, if it is not running yet.
+
+  cProfile only profiles the thread that enables it, so this profiles the
+  calling thread and worker threads join in at their next profile_thread().
+  """
+
+  global _profiler
+  with _profiler_condition:
+    if _profiler is None:
+      del _stopped_thread_profilers[:]
+      _profiler = cProfile.Profile()
+      _profiler.enable()
+      logger.info("Profiler enabled")
+
+
+def profile_thread(stop=False):
+  """Starts or stops profiling of the calling worker thread.
+
+  Worker threads call this regularly, e.g. once per batch, to follow
+  enable_profiler() and disable_profiler(), and with stop set before they
+  exit.
+  """
+
+  profiler = getattr(_thread_state, "profiler", None)
+  profiling = _profiler is not None and not stop
+  if profiling == (profiler is not None):
+    return
+  with _profiler_condition:
+    if profiler is None:
+      if _profiler is not None:
+        profiler = _thread_state.profiler = cProfile.Profile()
+        _thread_profilers.append(profiler)
+        profiler.enable()
+    else:
+      profiler.disable()
+      _thread_state.profiler = None
+      _thread_profilers.remove(profiler)
+      _stopped_thread_profilers.append(profiler)
+      _profiler_condition.notify_all()
+
+
+def disable_profiler(path=None, num_lines=30):
+  """Stops profiling and logs (or saves to <path>) the collected profile.
+
+  The profile combines the calling thread with the worker threads that stop
+  profiling within PROFILER_STOP_SECONDS.
+  """
+
+  global _profiler
+  with _profiler_condition:
+    if _profiler is None:
+      return
+    profiler, _profiler = _profiler, None
+    profiler.disable()
+    deadline = _clock() + PROFILER_STOP_SECONDS
+    while _thread_profilers and _clock() < deadline:
+      _profiler_condition.wait(deadline - _clock())
+    if _thread_profilers:
+      logger.warning("%d threads did not stop profiling in time",
+                     len(_thread_profilers))
+    thread_profilers = list(_stopped_thread_profilers)
+    del _stopped_thread_profilers[:]
+  stats = pstats.Stats(profiler)
+  for thread_profiler in thread_profilers:
+    stats.add(thread_profiler)
+  if path is not None:
+    stats.dump_stats(path)
+    logger.info("Profile written to %s", path)
+  else:
+    stats.sort_stats("cumulative").print_stats(num_lines)
+
+
+def toggle_profiler(*_):
+  """Enables the profiler if it is off and disables it otherwise."""
+
+  if _profiler is None:
+    enable_profiler()
+  else:
+    disable_profiler()
+
+
+def install_profiler_signal(signum=getattr(signal, "SIGUSR1", None)):
+  """Lets <signum> (SIGUSR1 by default) toggle the profiler at runtime."""
+
+  if signum is not None:
+    signal.signal(signum, toggle_profiler)
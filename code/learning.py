@@ -1,17 +1,48 @@
-import os, csv
-import tensorflow as tf
-from model import FeedModel
+import os, csv, sys
+import numpy as np
 import experience_batcher as experbatcher
 from experience_collector import ExperienceCollector
 import play
+from actors import ActorPool
+from prefetch import BatchPrefetcher, PREFETCH_DEPTH
+from inference import NumpyInference
+from replay_memory import ReplayMemory
+from checkpointing import AsyncCheckpointer
+from metrics import MetricsWriter
+from trajectory_store import TrajectoryReader, TrajectoryWriter
+import instrumentation
+from instrumentation import logger, timers
 NUM_OF_ACTIONS = 15
 
-def make_run_inference(session, model):
-  """Make run_inference() function for given session and model."""
+# Number of training steps between syncs of the target network
+TARGET_SYNC_STEPS = 1000
 
+# Number of training steps between parameter syncs of the numpy inference
+# engine that picks the actions
+INFERENCE_SYNC_STEPS = 100
+
+# Number of actor processes collecting experience (0: collect in the learner)
+NUM_ACTORS = 0
+
+# Number of training steps between parameter broadcasts to the actors
+ACTOR_SYNC_STEPS = 100
+
+# Number of training steps between evaluations of the histogram summaries
+HISTOGRAM_STEPS = 1000
+
+# Number of test experiences evaluated per session.run() by write_summaries()
+TEST_BATCH_SIZE = 4096
+
+def make_run_inference(session, model, target=False):
+  """Make run_inference() function for given session and model.
+
+  If target is set, the function evaluates the target network.
+  """
+
+  q_values = model.target_q_values if target else model.q_values
   def run_inference(state_batch):
     """Run inference on a given state_batch. Returns a q value batch."""
-    return session.run(model.q_values,
+    return session.run(q_values,
                        feed_dict={model.state_batch_placeholder: state_batch})
   return run_inference
 
@@ -28,7 +59,46 @@ def make_get_q_values(session, model):
     return q_values_batch[0]
   return get_q_values
 
-def run_training(train_dir):
+def write_summaries(session, batcher, model, test_memory, metrics, global_step):
+    """Evaluates the loss on the test experiences and adds it to metrics.
+
+    The targets are computed like those of the training batches (n-step
+    returns, current target network), then the loss is evaluated in batches
+    of TEST_BATCH_SIZE.
+
+    Args:
+      test_memory: ReplayMemory holding the test experiences in game order.
+
+    Returns:
+      The mean test loss.
+    """
+
+    num_experiences = len (test_memory)
+    states, targets, actions = batcher.memory_to_batches (test_memory, np.arange (num_experiences))
+    total_loss = 0.0
+    for start in range (0, num_experiences, TEST_BATCH_SIZE):
+        stop = min (start + TEST_BATCH_SIZE, num_experiences)
+        loss = session.run (model.loss, feed_dict={model.state_batch_placeholder: states[start:stop],
+                                                   model.targets_placeholder: targets[start:stop],
+                                                   model.actions_placeholder: actions[start:stop]})
+        total_loss += loss * (stop - start)
+    test_loss = total_loss / max (num_experiences, 1)
+    metrics.scalar ("Test Loss", test_loss, global_step)
+    return test_loss
+
+def run_training(train_dir, num_actors=NUM_ACTORS,
+                 prefetch_depth=PREFETCH_DEPTH, record_dir=None,
+                 offline_dir=None):
+    """Trains the model in train_dir.
+
+    Args:
+      record_dir: Optional directory the played games are recorded to.
+      offline_dir: Optional directory of recorded games to train on instead
+          of playing games.
+    """
+    # TensorFlow takes seconds to import, so it is only loaded to train.
+    import tensorflow as tf
+    from model import FeedModel
     with tf.Graph().as_default():
         model = FeedModel()
         saver = tf.train.Saver()
@@ -36,35 +106,96 @@ def run_training(train_dir):
         summary_writer = tf.summary.FileWriter(train_dir,
                                                graph_def=session.graph_def,
                                                flush_secs=10)
-        #resume = os.path.exists(train_dir)
-        #print("Resume: ", resume)
-        #if resume:
-        #    print("Resuming: ", train_dir)
-        #    saver.restore(session, tf.train.latest_checkpoint(train_dir))
-        #else:
-        print("Starting new training: ", train_dir)
+        # Checkpoints include the global step and the optimizer slots.
+        checkpointer = AsyncCheckpointer(os.path.join(train_dir, "checkpoints"),
+                                         tf.global_variables())
         session.run(model.init)
-    print("Aravind, tell me you are here")
-    run_inference = make_run_inference (session, model)
-    print ("Before for loop in learning.py 1")
-    get_q_values = make_get_q_values (session, model)
+        training_state = checkpointer.restore(session)
+        checkpoint = tf.train.latest_checkpoint(train_dir)
+        if training_state is not None:
+            logger.info("Resuming from step %d", training_state["step"])
+        elif checkpoint is not None:
+            # Checkpoint written by tf.train.Saver before AsyncCheckpointer.
+            logger.info("Resuming: %s", checkpoint)
+            saver.restore(session, checkpoint)
+        else:
+            logger.info("Starting new training: %s", train_dir)
+            session.run(model.target_sync_op)
+    # Acting and target computation run in numpy on parameter snapshots,
+    # which is much faster than session.run() for a network this small.
+    target_inference = NumpyInference ()
+    target_inference.sync (session, model, target=True)
+    run_inference = target_inference.run_inference
+    acting_inference = NumpyInference ()
+    acting_inference.sync (session, model)
+    get_q_values = acting_inference.get_q_values
     STATE_NORMALIZE_FACTOR = 1
-    print ("Before for loop in learning.py 2")
-    experience_collector = ExperienceCollector ()
-    print ("Before for loop in learning.py 3")
-    batcher = experbatcher.ExperienceBatcher (experience_collector, run_inference, get_q_values, STATE_NORMALIZE_FACTOR)
-    print ("Before for loop in learning.py 4")
-    test_experiences = experience_collector.collect (play.random_strategy, NUM_OF_ACTIONS)
-    print("Before for loop in learning.py 5")
-    for state_batch, targets, actions in batcher.get_batches_stepwise ():
-
-        global_step, _ = session.run ([model.global_step, model.train_op],
-                                    feed_dict={model.state_batch_placeholder: state_batch,
-                                      model.targets_placeholder: targets, model.actions_placeholder: actions, })
+    recorder = None
+    if record_dir is not None:
+        recorder = TrajectoryWriter (record_dir)
+    experience_collector = ExperienceCollector (recorder=recorder)
+    # The replay memory is snapshotted with every checkpoint, so a restarted
+    # run reopens it instead of refilling it.
+    memory_dir = os.path.join (train_dir, "replay_memory")
+    actor_pool = None
+    if num_actors > 0:
+        actor_pool = ActorPool (num_actors, session.run (model.weights + model.biases))
+    batcher = experbatcher.ExperienceBatcher (experience_collector, run_inference, get_q_values, STATE_NORMALIZE_FACTOR, memory_dir, actor_pool,
+                                              num_buffer_sets=prefetch_depth + 2)
+    if training_state is not None:
+        batcher.epsilon_step = training_state.get ("epsilon_step", 0)
+    # Test games are neither recorded nor deduplicated against training games,
+    # so training on a recording never sees the test set.
+    test_experiences = ExperienceCollector ().collect (play.random_strategy, NUM_OF_ACTIONS)
+    # Kept in game order, so that the test targets use n-step returns as well.
+    test_memory = ReplayMemory (capacity=max (len (test_experiences), 1))
+    if test_experiences:
+        test_memory.add_batch (**play.experiences_to_columns (test_experiences))
+    # Summaries are buffered and written on a background thread.
+    metrics = MetricsWriter (summary_writer)
+    # Batches are prepared on a background thread while the train op runs.
+    if offline_dir is not None:
+        batches = batcher.get_offline_batches (TrajectoryReader (offline_dir))
+    else:
+        batches = batcher.get_batches ()
+    batches = BatchPrefetcher (batches, prefetch_depth)
+    instrumentation.install_profiler_signal ()
+    for state_batch, targets, actions, importance_weights, indices in batches:
+
+        feed_dict = {model.state_batch_placeholder: state_batch,
+                     model.targets_placeholder: targets, model.actions_placeholder: actions,
+                     model.importance_weights_placeholder: importance_weights, }
+        with timers.timer ("train_step"):
+            global_step, _, td_errors, train_loss, learning_rate = session.run (
+                [model.global_step, model.train_op, model.td_errors, model.loss, model.learning_rate],
+                feed_dict=feed_dict)
+        batcher.memory.update_priorities (indices, td_errors)
+        metrics.scalar ("Loss", train_loss, global_step)
+        metrics.scalar ("Average Target", targets.mean (), global_step)
+        metrics.scalar ("Learning Rate", learning_rate, global_step)
+        if global_step % HISTOGRAM_STEPS == 0:
+            with timers.timer ("histograms"):
+                metrics.summary (session.run (model.histogram_summary_op, feed_dict=feed_dict), global_step)
+        timers.maybe_report ()
+        if global_step % TARGET_SYNC_STEPS == 0:
+            session.run (model.target_sync_op)
+            target_inference.sync (session, model, target=True)
+        if global_step % INFERENCE_SYNC_STEPS == 0:
+            acting_inference.sync (session, model)
+        if actor_pool is not None and global_step % ACTOR_SYNC_STEPS == 0:
+            actor_pool.broadcast (acting_inference.parameters ())
         if global_step % 1e3 == 0 and global_step != 0:
-            saver.save (session, train_dir + "/checkpoint", global_step=global_step)
-            loss = write_summaries (session, batcher, model, test_experiences, summary_writer)
-            print ("Step:", global_step, "Loss:", loss)
+            # Written on a background thread, training continues meanwhile.
+            checkpointer.save (session, global_step, {"epsilon_step": batcher.epsilon_step},
+                               batcher.memory)
+            if recorder is not None:
+                recorder.flush ()
+            with timers.timer ("test_loss"):
+                loss = write_summaries (session, batcher, model, test_memory, metrics, global_step)
+            logger.info ("Step: %d Loss: %s", global_step, loss)
+            batches.print_stats ()
+            if actor_pool is not None:
+                actor_pool.print_throughput ()
 
 def main(args):
     if len(args) != 2:
@@ -75,4 +206,5 @@ def main(args):
 
 
 if __name__ == '__main__':
+    import tensorflow as tf
     tf.app.run()
@@ -0,0 +1,102 @@
+"""Training metrics that are buffered and written on a background thread."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+from instrumentation import logger
+
+# Seconds between two flushes of the buffered metrics
+FLUSH_SECONDS = 10.0
+
+# Maximum number of buffered summaries; older ones are dropped beyond it
+MAX_BUFFERED_SUMMARIES = 1000
+
+
+class MetricsWriter(object):
+  """Buffers metrics in-process and writes them from a background thread.
+
+  Scalars cost a dict update per call: values of the same tag are averaged
+  until the next flush, which writes the mean at the last step seen.
+  Serialized summaries (e.g. histograms evaluated every few steps) are
+  queued as they are. Every flush_seconds, the writer thread converts the
+  buffer to summaries and adds them to the summary writer, so the training
+  loop never waits for event files.
+  """
+
+  def __init__(self, summary_writer, flush_seconds=FLUSH_SECONDS,
+               max_buffered=MAX_BUFFERED_SUMMARIES):
+    """Init MetricsWriter and start the writer thread.
+
+    Args:
+      summary_writer: A tf.summary.FileWriter.
+      flush_seconds: Seconds between two flushes.
+      max_buffered: Maximum number of queued serialized summaries.
+    """
+    self.summary_writer = summary_writer
+    self.flush_seconds = flush_seconds
+    self.max_buffered = max_buffered
+    self._lock = threading.Lock()
+    self._scalars = {}
+    self._summaries = []
+    self.dropped = 0
+    self._stopped = threading.Event()
+
+    self._thread = threading.Thread(target=self._write_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def scalar(self, tag, value, step):
+    """Adds a value to the mean of <tag> that is written at the next flush."""
+
+    with self._lock:
+      total, count, _ = self._scalars.get(tag, (0.0, 0, step))
+      self._scalars[tag] = (total + float(value), count + 1, step)
+
+
+  def summary(self, serialized_summary, step):
+    """Queues a serialized Summary, e.g. the result of a summary op."""
+
+    with self._lock:
+      if len(self._summaries) >= self.max_buffered:
+        self._summaries.pop(0)
+        self.dropped += 1
+      self._summaries.append((serialized_summary, step))
+
+
+  def _write_loop(self):
+    """Writer thread: flushes every flush_seconds until stopped."""
+
+    while not self._stopped.wait(self.flush_seconds):
+      self.flush()
+    self.flush()
+
+
+  def flush(self):
+    """Writes all buffered metrics."""
+
+    with self._lock:
+      scalars, self._scalars = self._scalars, {}
+      summaries, self._summaries = self._summaries, []
+    if not scalars and not summaries:
+      return
+    try:
+      import tensorflow as tf
+      for tag, (total, count, step) in sorted(scalars.items()):
+        value = tf.Summary.Value(tag=tag, simple_value=total / count)
+        self.summary_writer.add_summary(tf.Summary(value=[value]), step)
+      for serialized_summary, step in summaries:
+        self.summary_writer.add_summary(serialized_summary, step)
+      self.summary_writer.flush()
+    except Exception as error:  # pylint: disable=broad-except
+      logger.error("Writing metrics failed: %s", error)
+
+
+  def stop(self):
+    """Flushes the buffered metrics and stops the writer thread."""
+
+    self._stopped.set()
+    self._thread.join()
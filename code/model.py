@@ -16,6 +16,14 @@ OPTIMIZER_CLASS = tf.train.AdamOptimizer
 ACTIVATION_FUNCTION = tf.nn.relu
 WEIGHT_INIT_SCALE = 0.01
 
+# Rate at which the target network follows the online network on every sync:
+# 1.0 copies the weights, smaller values give a Polyak average.
+TARGET_UPDATE_RATE = 1.0
+
+# Collection of the histogram summaries, which are expensive to evaluate and
+# are run separately from the scalar summaries
+HISTOGRAM_SUMMARIES = "histogram_summaries"
+
 # Learning Rate Parameters
 INIT_LEARNING_RATE = 1e-4
 LR_DECAY_PER_100K = 0.98
@@ -24,11 +32,13 @@ class FeedModel(object):
   """Class to construct and collect all relevant tensors of the model."""
 
   def __init__(self):
-    print("It is in model/FeedModel code")
     self.state_batch_placeholder = tf.placeholder(
         tf.float32, shape=(None, NUM_ELEMENTS_IN_STATE))
     self.targets_placeholder = tf.placeholder(tf.float32, shape=(None,))
     self.actions_placeholder = tf.placeholder(tf.int32, shape=(None,))
+    # Importance-sampling weights of prioritized replay, one per experience.
+    self.importance_weights_placeholder = tf.placeholder_with_default(
+        tf.ones_like(self.targets_placeholder), shape=(None,))
     self.placeholders = (self.state_batch_placeholder,
                          self.targets_placeholder,
                          self.actions_placeholder)
@@ -36,8 +46,19 @@ class FeedModel(object):
     self.weights, self.biases, self.activations = build_inference_graph(
         self.state_batch_placeholder, HIDDEN_SIZES)
     self.q_values = self.activations[-1]
-    self.loss = build_loss(self.q_values, self.targets_placeholder,
-                     self.actions_placeholder)
+
+    # Frozen copy of the network that the targets are computed with.
+    with tf.name_scope("target"):
+      self.target_weights, self.target_biases, target_activations = (
+          build_inference_graph(self.state_batch_placeholder, HIDDEN_SIZES,
+                                trainable=False))
+    self.target_q_values = target_activations[-1]
+    self.target_sync_op = build_target_sync_op(
+        self.weights + self.biases, self.target_weights + self.target_biases,
+        TARGET_UPDATE_RATE)
+    self.loss, self.td_errors = build_loss(
+        self.q_values, self.targets_placeholder, self.actions_placeholder,
+        self.importance_weights_placeholder)
     self.train_op, self.global_step, self.learning_rate = (
         build_train_op(self.loss))
 
@@ -45,14 +66,19 @@ class FeedModel(object):
                       tf.reduce_mean(self.targets_placeholder))
     tf.summary.scalar("Learning Rate", self.learning_rate)
     tf.summary.scalar("Loss", self.loss)
-    tf.summary.histogram("States", self.state_batch_placeholder)
-    tf.summary.histogram("Targets", self.targets_placeholder)
+    tf.summary.histogram("States", self.state_batch_placeholder,
+                         collections=[HISTOGRAM_SUMMARIES])
+    tf.summary.histogram("Targets", self.targets_placeholder,
+                         collections=[HISTOGRAM_SUMMARIES])
 
     self.init = tf.initialize_all_variables()
-    self.summary_op = tf.summary.merge_all()
+    self.scalar_summary_op = tf.summary.merge_all()
+    self.histogram_summary_op = tf.summary.merge_all(key=HISTOGRAM_SUMMARIES)
+    self.summary_op = tf.summary.merge([self.scalar_summary_op,
+                                        self.histogram_summary_op])
 
 
-def build_inference_graph(state_batch, hidden_sizes):
+def build_inference_graph(state_batch, hidden_sizes, trainable=True):
   """Build inference model.
 
   Args:
@@ -60,6 +86,8 @@ def build_inference_graph(state_batch, hidden_sizes):
     hidden_sizes: Array of numbers where len(hidden_sizes) is the number of
         hidden layers and hidden_sizes[i] is the number of hidden units in the
         ith layer.
+    trainable: Whether the variables are trained by the optimizer. Summaries
+        are only added for trainable layers.
 
   Returns:
     q_values: Output tensor with the computed Q-Values.
@@ -74,7 +102,7 @@ def build_inference_graph(state_batch, hidden_sizes):
   for i, hidden_size in enumerate(hidden_sizes):
     weights_i, biases_i, hidden_output_i = build_fully_connected_layer(
         'hidden' + str(i), input_batch, input_size, hidden_size,
-        ACTIVATION_FUNCTION)
+        ACTIVATION_FUNCTION, trainable)
 
     weights.append(weights_i)
     biases.append(biases_i)
@@ -84,7 +112,7 @@ def build_inference_graph(state_batch, hidden_sizes):
     input_size = hidden_size
 
   weights_qvalues, biases_qvalues, output = build_fully_connected_layer(
-      'q_values', input_batch, input_size, NUM_ACTIONS)
+      'q_values', input_batch, input_size, NUM_ACTIONS, trainable=trainable)
 
   weights.append(weights_qvalues)
   biases.append(biases_qvalues)
@@ -94,7 +122,8 @@ def build_inference_graph(state_batch, hidden_sizes):
 
 
 def build_fully_connected_layer(name, input_batch, input_size, layer_size,
-                                activation_function=lambda x: x):
+                                activation_function=lambda x: x,
+                                trainable=True):
   """Builds a fully connected layer.
 
   Args:
@@ -104,6 +133,7 @@ def build_fully_connected_layer(name, input_batch, input_size, layer_size,
     input_size: Number of input units.
     layer_size: Number of units in this layer.
     activation_function: Activation Function to use. Defaults to none.
+    trainable: Whether the variables are trained and get summaries.
 
   Returns:
     The [batch_size, layer_size] output_batch Tensor.
@@ -111,18 +141,23 @@ def build_fully_connected_layer(name, input_batch, input_size, layer_size,
   with tf.name_scope(name):
     weights = tf.Variable(tf.truncated_normal([input_size, layer_size],
                                               stddev=WEIGHT_INIT_SCALE),
-                          name='weights')
-    biases = tf.Variable(tf.zeros([layer_size]), name='biases')
+                          name='weights', trainable=trainable)
+    biases = tf.Variable(tf.zeros([layer_size]), name='biases',
+                         trainable=trainable)
     output_batch = activation_function(tf.matmul(input_batch, weights) + biases)
 
-    tf.summary.histogram("Weights " + name, weights)
-    tf.summary.histogram("Biases " + name, biases)
-    tf.summary.histogram("Activations " + name, output_batch)
+    if trainable:
+      tf.summary.histogram("Weights " + name, weights,
+                           collections=[HISTOGRAM_SUMMARIES])
+      tf.summary.histogram("Biases " + name, biases,
+                           collections=[HISTOGRAM_SUMMARIES])
+      tf.summary.histogram("Activations " + name, output_batch,
+                           collections=[HISTOGRAM_SUMMARIES])
 
     return weights, biases, output_batch
 
 
-def build_loss(q_values, targets, actions):
+def build_loss(q_values, targets, actions, importance_weights=None):
   """Calculates the loss from the Q-Values, targets and actions.
 
   Args:
@@ -131,17 +166,49 @@ def build_loss(q_values, targets, actions):
     targets: A [batch_size] float Tensor. Contains the current target Q-Values
         for the action taken.
     actions: A [batch_size] int Tensor. Contains the actions taken.
+    importance_weights: Optional [batch_size] float Tensor. Weights of the
+        squared errors of the experiences, used by prioritized replay.
 
   Returns:
-    loss: Loss tensor of type float.
+    loss, td_errors: Loss tensor of type float and the [batch_size] float
+        Tensor of differences between the Q-Values and the targets.
   """
   # Get Q-Value predictions for the given actions
   batch_size = tf.shape(q_values)[0]
   q_value_indices = tf.range(0, batch_size) * NUM_ACTIONS + actions
   relevant_q_values = tf.gather(tf.reshape(q_values, [-1]), q_value_indices)
 
+  td_errors = relevant_q_values - targets
+
   # Compute L2 loss (tf.nn.l2_loss() doesn't seem to be available on CPU)
-  return tf.reduce_mean(tf.pow(relevant_q_values - targets, 2))
+  squared_errors = tf.pow(td_errors, 2)
+  if importance_weights is not None:
+    squared_errors *= importance_weights
+  return tf.reduce_mean(squared_errors), td_errors
+
+
+def build_target_sync_op(variables, target_variables, update_rate):
+  """Sets up the Op that moves the target network towards the online network.
+
+  Args:
+    variables: List of the online network's variables.
+    target_variables: List of the target network's variables, in the same
+        order.
+    update_rate: Float in (0, 1]. Each sync sets target = update_rate * online
+        + (1 - update_rate) * target.
+
+  Returns:
+    target_sync_op.
+  """
+  updates = []
+  for variable, target_variable in zip(variables, target_variables):
+    if update_rate == 1.0:
+      updates.append(tf.assign(target_variable, variable))
+    else:
+      updates.append(tf.assign(target_variable,
+                               update_rate * variable +
+                               (1 - update_rate) * target_variable))
+  return tf.group(*updates)
 
 
 def build_train_op(loss):
@@ -0,0 +1,172 @@
+"""Lookahead planner that simulates all actions with array operations."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import math
+
+import numpy as np
+
+import vehicle
+
+# Number of actions to look ahead
+PLANNER_DEPTH = 3
+
+# Number of poses expanded further at every depth
+PLANNER_BEAM_WIDTH = 64
+
+# Maximum number of simulated steps per plan() call
+PLANNER_MAX_EXPANSIONS = 4096
+
+# Grid cell size for merging poses and for the cache of plans
+PLANNER_RESOLUTION = 1e-2
+
+# Maximum number of cached plans
+PLANNER_CACHE_SIZE = int(1e5)
+
+# Weight of the heading error (radians) against the distance (meters) in the
+# score of poses that did not reach the target
+ANGLE_WEIGHT = 0.5
+
+# Distance (meters) from the target within which the heading is scored against
+# the target heading instead of the direction to the target
+APPROACH_DISTANCE = 2.0
+
+# Score of reaching the target, reduced by the number of actions it took
+GOAL_SCORE = 1e3
+
+
+def apply_motion(states, motions):
+  """Returns the (N, 4) states reached by (N, 4) rows of a motion_table()."""
+  heading = states[:, 3]
+  cos_heading = np.cos(heading)
+  sin_heading = np.sin(heading)
+  next_states = np.empty_like(states)
+  next_states[:, 0] = (states[:, 0] + cos_heading * motions[:, 0] -
+                       sin_heading * motions[:, 1])
+  next_states[:, 1] = (states[:, 1] + sin_heading * motions[:, 0] +
+                       cos_heading * motions[:, 1])
+  next_states[:, 2] = motions[:, 3]
+  new_heading = heading + motions[:, 2]
+  new_heading[new_heading > math.pi] -= 2 * math.pi
+  new_heading[new_heading < -math.pi] += 2 * math.pi
+  next_states[:, 3] = new_heading
+  return next_states
+
+
+class LookaheadPlanner(object):
+  """Picks actions by simulating all action sequences up to a given depth.
+
+  At every depth, all actions are applied to all poses of the frontier in one
+  array operation. Poses that fall into the same grid cell are merged and
+  only the beam_width best poses are expanded further, and planning stops
+  early once max_expansions steps were simulated. Each first action is scored
+  with the best pose reachable after it: GOAL_SCORE minus the depth if the
+  target is reached, otherwise score(). Plans are cached by the quantized
+  pose and target.
+  """
+
+  def __init__(self, depth=PLANNER_DEPTH, beam_width=PLANNER_BEAM_WIDTH,
+               max_expansions=PLANNER_MAX_EXPANSIONS,
+               dt=vehicle.SIMULATION_TIMESTEP, resolution=PLANNER_RESOLUTION,
+               cache_size=PLANNER_CACHE_SIZE):
+    self.depth = depth
+    self.beam_width = beam_width
+    self.max_expansions = max_expansions
+    self.resolution = resolution
+    self.cache_size = cache_size
+    self._table = vehicle.motion_table(dt)
+    self._cache = collections.OrderedDict()
+
+
+  def score(self, states, target_state):
+    """Returns the (N,) heuristic scores of states that missed the target.
+
+    Far from the target, the heading should point at it; within
+    APPROACH_DISTANCE, it should match the target heading. The steering is
+    not scored, as the last action sets it directly.
+    """
+
+    delta_x = target_state[0] - states[:, 0]
+    delta_y = target_state[1] - states[:, 1]
+    distance = np.hypot(delta_x, delta_y)
+    desired_heading = np.where(distance < APPROACH_DISTANCE, target_state[3],
+                               np.arctan2(delta_y, delta_x))
+    heading_error = np.abs(np.mod(states[:, 3] - desired_heading + math.pi,
+                                  2 * math.pi) - math.pi)
+    return -(distance + ANGLE_WEIGHT * heading_error)
+
+
+  def action_scores(self, state, target_state):
+    """Returns a (NUM_OF_ACTIONS,) array with the score of every first
+    action."""
+
+    target_state = np.asarray(target_state, dtype=np.float64)
+    num_actions = len(self._table)
+    scores = np.full((num_actions,), -np.inf)
+    poses = np.asarray(state, dtype=np.float64).reshape(1, 4)
+    first_actions = np.zeros((1,), dtype=np.int64)
+    expansions = 0
+
+    for level in range(self.depth):
+      num_poses = len(poses)
+      children = apply_motion(np.repeat(poses, num_actions, axis=0),
+                              np.tile(self._table, (num_poses, 1)))
+      if level == 0:
+        child_first_actions = np.arange(num_actions)
+      else:
+        child_first_actions = np.repeat(first_actions, num_actions)
+      expansions += len(children)
+
+      reached = vehicle.goals_reached(children, target_state)
+      child_scores = self.score(children, target_state)
+      child_scores[reached] = GOAL_SCORE - level
+      np.maximum.at(scores, child_first_actions, child_scores)
+
+      if (level + 1 == self.depth or
+          expansions + min(len(children), self.beam_width) * num_actions >
+          self.max_expansions):
+        break
+
+      # Expand the best poses that did not reach the target yet, one per cell.
+      keep = np.flatnonzero(np.logical_not(reached))
+      keys = vehicle.quantized_keys(children[keep], self.resolution)
+      keep = keep[np.unique(keys, return_index=True)[1]]
+      if len(keep) > self.beam_width:
+        best = np.argpartition(-child_scores[keep], self.beam_width)
+        keep = keep[best[:self.beam_width]]
+      if not len(keep):
+        break
+      poses = children[keep]
+      first_actions = child_first_actions[keep]
+
+    return scores
+
+
+  def plan(self, state, target_state, actions=None):
+    """Returns the best first action from state towards target_state.
+
+    Args:
+      state: The current [x, y, steering, heading].
+      target_state: The target [x, y, steering, heading].
+      actions: Optional list of available actions, defaults to all.
+    """
+
+    key = tuple(vehicle.quantized_keys(
+        np.array([state, target_state], dtype=np.float64),
+        self.resolution).tolist())
+    scores = self._cache.get(key)
+    if scores is None:
+      scores = self.action_scores(state, target_state)
+      self._cache[key] = scores
+      if len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+    else:
+      self._cache.move_to_end(key)
+
+    if actions is None:
+      return int(scores.argmax())
+    actions = np.asarray(actions)
+    return int(actions[scores[actions].argmax()])
@@ -4,13 +4,40 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import math
+import time
+
 import numpy as np
-from vehicle import Vehicle_Controller
+from instrumentation import logger, timers
+from planner import LookaheadPlanner
+from vehicle import ACTION_NAMES, MAX_EPISODE_STEPS, NUM_OF_ACTIONS
+from vehicle import POSITION_BOUND, SimulationClock, Vehicle_Controller
 # pylint: disable=too-many-arguments,too-few-public-methods
+
+# Number of experiences per chunk yielded by follow_stream()
+STREAM_CHUNK_SIZE = 64
+
+# Parameters for the episode scheduler: besides the bounds of
+# vehicle.MAX_EPISODE_STEPS and vehicle.POSITION_BOUND, games are truncated
+# after MAX_EPISODE_SECONDS of wall time (None: no limit).
+MAX_EPISODE_SECONDS = None
+
+# Start and target of the fixed game, see fixed_episode()
+DEFAULT_INITIAL_STATE = [6.436814971, 6.613150112, -0.526185188, 0.154138194]
+DEFAULT_TARGET_STATE = [6.437283741, 6.613119713, -0.526327424, 0.153992516]
+
+# Maximum distance in x and y of random starts from DEFAULT_INITIAL_STATE
+RANDOM_START_DISTANCE = 10.0
+
+# Maximum distance in x and y of random targets from the start
+RANDOM_TARGET_DISTANCE = 10.0
+
 class Experience(object):
   """Struct to encapsulate the experience of a single turn."""
 
-  def __init__(self, state, action, reward, next_state, game_over):
+  def __init__(self, state, action, reward, next_state, game_over,
+               not_available=False, next_state_available_actions=None,
+               truncated=False):
     """Initialize Experience
 
     Args:
@@ -19,17 +46,113 @@ class Experience(object):
       reward: Number, experienced reward
       next_state: Shape (4, 4) numpy array, the state after the action was
           executed
-      game_over: boolean, whether the
+      game_over: boolean, whether the game ended in next_state because the
+          target was reached or the vehicle left the allowed area
+      not_available: boolean, whether the action was not available.
+      next_state_available_actions: Actions that are available from
+          next_state. None means all actions are available.
+      truncated: boolean, whether the game was cut off after this experience
+          by a step or time limit. Unlike game_over, next_state still has a
+          future.
     """
     self.state = state
     self.action = action
     self.reward = reward
     self.next_state = next_state
     self.game_over = game_over
+    self.not_available = not_available
+    self.next_state_available_actions = next_state_available_actions
+    self.truncated = truncated
+
+
+def fixed_episode():
+  """Returns the start and target state of the fixed game."""
+  return list(DEFAULT_INITIAL_STATE), list(DEFAULT_TARGET_STATE)
+
+
+def _random_pose(center, distance):
+  """Returns a state within distance of center in x and y with a random
+  steering angle and heading."""
+  return [
+      center[0] + np.random.uniform(-distance, distance),
+      center[1] + np.random.uniform(-distance, distance),
+      np.random.uniform(-math.pi / 4, math.pi / 4),
+      np.random.uniform(-math.pi, math.pi)]
+
+
+def random_episode():
+  """Returns a random start near the default start and a random target near
+  that start."""
+  initial_state = _random_pose(DEFAULT_INITIAL_STATE, RANDOM_START_DISTANCE)
+  target_state = _random_pose(initial_state, RANDOM_TARGET_DISTANCE)
+  return initial_state, target_state
+
+
+class EpisodeScheduler(object):
+  """Decides when a game ends and where the next one starts.
+
+  A game ends with game_over when the target is reached (positive reward),
+  the vehicle leaves the allowed area or the simulation is stopped. It is
+  truncated when it exceeds max_steps actions or max_seconds of wall time.
+  Every game starts from a fresh start/target pair of episode_source.
+  """
+
+  def __init__(self, max_steps=MAX_EPISODE_STEPS,
+               max_seconds=MAX_EPISODE_SECONDS, position_bound=POSITION_BOUND,
+               episode_source=random_episode):
+    """Init EpisodeScheduler.
+
+    Args:
+      max_steps: Maximum number of actions per game, or None.
+      max_seconds: Maximum wall time per game in seconds, or None.
+      position_bound: The game is lost if |x| or |y| exceeds it.
+      episode_source: function () -> initial_state, target_state. Defaults
+          to random_episode(); pass fixed_episode to replay the fixed game or
+          routes.Route.make_episode_source() to drive along a logged route.
+    """
+    self.max_steps = max_steps
+    self.max_seconds = max_seconds
+    self.position_bound = position_bound
+    self.episode_source = episode_source
+    self.steps = 0
+    self.target_state = None
+    self._start_time = None
+
+
+  def start(self):
+    """Starts a new game. Returns its initial_state, target_state."""
+
+    self.steps = 0
+    self._start_time = time.time()
+    initial_state, self.target_state = self.episode_source()
+    return initial_state, self.target_state
 
 
+  def step(self, state, reward, simulation_over=False):
+    """Accounts for one action.
+
+    Args:
+      state: The state reached by the action.
+      reward: The reward of the action.
+      simulation_over: Whether the controller stopped the simulation.
+
+    Returns:
+      game_over, truncated.
+    """
+
+    self.steps += 1
+    game_over = bool(reward > 0 or simulation_over or
+                     abs(state[0]) > self.position_bound or
+                     abs(state[1]) > self.position_bound)
+    truncated = not game_over and (
+        (self.max_steps is not None and self.steps >= self.max_steps) or
+        (self.max_seconds is not None and
+         time.time() - self._start_time >= self.max_seconds))
+    return game_over, truncated
 
-def Follow(strategy, verbose=False):
+
+def Follow(strategy, verbose=False, clock=None, max_steps=None,
+           scheduler=None):
   """Plays a single game, using a provided strategy.
 
   Args:
@@ -38,55 +161,97 @@ def Follow(strategy, verbose=False):
     allow_unavailable_action: Boolean, whether strategy is passed all actions
         or just the available ones.
     verbose: If true, prints game states, actions and scores.
+    clock: Clock that drives the vehicle. Defaults to a SimulationClock with a
+        fixed timestep, so the game runs as fast as possible and is
+        reproducible. Pass a RealTimeClock for the hardware loop.
+    max_steps: Maximum number of actions, used if no scheduler is given.
+        Defaults to MAX_EPISODE_STEPS.
+    scheduler: EpisodeScheduler that picks start and target and ends the
+        game. Defaults to an EpisodeScheduler with max_steps.
 
   Returns:
-    score, experiences where score is the final score and experiences is the
-        list Experience instances that represent the collected experience.
+    experiences, the list of Experience instances that represent the collected
+        experience.
   """
-  # eventually to be removed
-  '''
-  csv_path = 'C:/Users/Aravind/Documents/NCSU/3rd sem/ECE 542/project06/'
-  os.chdir (csv_path)
-  file_name = None
-  for i in glob.glob('*.*'):
-      if i == 'odom_simplified.csv':
-          file_name  = i
-          break
-  with open (file_name) as f:
-      a = csv.reader (f)
-  '''
-  initial_state = [6.436814971,	6.613150112	, -0.526185188,	0.154138194]
-  final_state = [6.437283741,	6.613119713,	-0.526327424,	0.153992516]
-  controller = Vehicle_Controller(initial_state, final_state, stop_simulation = False)
-  print("1st checkpoint")
+  experiences = []
+  for chunk in follow_stream(strategy, verbose=verbose, clock=clock,
+                             max_steps=max_steps, scheduler=scheduler):
+    experiences += chunk
+  return experiences
+
+
+def follow_stream(strategy, chunk_size=STREAM_CHUNK_SIZE, verbose=False,
+                  clock=None, max_steps=None, scheduler=None):
+  """Plays a single game like Follow(), yielding the experiences as it goes.
+
+  Memory stays bounded by chunk_size even for games that never end.
+
+  Args:
+    strategy: See Follow().
+    chunk_size: Maximum number of experiences per yielded list.
+    verbose: See Follow().
+    clock: See Follow().
+    max_steps: See Follow().
+    scheduler: See Follow().
+
+  Yields:
+    Lists of at most chunk_size consecutive Experience instances.
+  """
+  if scheduler is None:
+    scheduler = EpisodeScheduler(
+        max_steps=max_steps if max_steps is not None else MAX_EPISODE_STEPS)
+  initial_state, final_state = scheduler.start()
+  if clock is None:
+    clock = SimulationClock()
+  controller = Vehicle_Controller(initial_state, final_state,
+                                  stop_simulation = False, clock=clock)
   state = controller.state()
-  print ("2nd checkpoint")
-  print("Current state: ", state)
+  logger.debug("Current state: %s", state)
   game_over = controller.simulation_over()
-  print ("3rd checkpoint")
-  print("Is simulation over?", True if game_over == 1 else False)
+  logger.debug("Is simulation over? %s", bool(game_over))
+  truncated = False
   experiences = []
-  print("Just before entering for loop")
-  while not game_over:
+  while not (game_over or truncated):
     if verbose:
       controller.print_state()
 
     old_state = state
-    #print("Tell me you are here in play.py")
     next_action = strategy(
         old_state, range(15))
-    print(next_action)
-    #print ("Tell me you are here in stage 2 in play.py")
-    reward = controller.do_action(next_action)
-    print("Reward", reward)
+    with timers.timer("simulate"):
+      reward = controller.do_action(next_action)
+    logger.debug("Action %s, reward %s", next_action, reward)
     state = controller.state()
-    game_over = controller.simulation_over()
+    game_over, truncated = scheduler.step(state, reward,
+                                          controller.simulation_over())
 
     if verbose:
       print("Action:", ACTION_NAMES[next_action])
       print("Reward:", reward)
-    experiences.append(Experience(old_state, next_action, reward, state, False))
-  return experiences
+    experiences.append(Experience(old_state, next_action, reward, state,
+                                  game_over, truncated=truncated))
+    if len(experiences) >= chunk_size:
+      yield experiences
+      experiences = []
+  if experiences:
+    yield experiences
+
+
+def experiences_to_columns(experiences):
+  """Converts a list of Experiences to the arrays ReplayMemory.add_batch()
+  takes."""
+  return {
+      "states": np.array([np.ravel(e.state) for e in experiences],
+                         dtype=np.float32),
+      "actions": np.array([e.action for e in experiences], dtype=np.int32),
+      "rewards": np.array([e.reward for e in experiences], dtype=np.float32),
+      "next_states": np.array([np.ravel(e.next_state) for e in experiences],
+                              dtype=np.float32),
+      "game_over": np.array([e.game_over for e in experiences], dtype=bool),
+      "not_available": np.array([e.not_available for e in experiences],
+                                dtype=bool),
+      "truncated": np.array([e.truncated for e in experiences], dtype=bool),
+  }
 
 
 def random_strategy(_, actions):
@@ -97,16 +262,26 @@ def static_preference_strategy(_, actions):
   """Always prefer left over up over right over top."""
   return actions
 
-def highest_reward_strategy(state, actions):
-  """Strategy that always chooses the action of highest immediate reward.
+def make_planner_strategy(planner, scheduler):
+  """Makes planner_strategy.
 
-  If there are any ties, the strategy prefers left over up over right over down.
+  Args:
+    planner: A LookaheadPlanner.
+    scheduler: The EpisodeScheduler of the game, which knows its target. Pass
+        the same scheduler to Follow().
   """
-  sorted_actions = np.sort(actions)[::-1]
-  rewards = [Vehicle_Controller(np.copy(state)).do_action(action)
-             for action in sorted_actions]
-  action_index = np.argsort(rewards)[-1]
-  return sorted_actions[action_index]
+
+  def planner_strategy(state, actions):
+    """Picks the action the planner finds best towards the target."""
+    return planner.plan(state, scheduler.target_state, actions)
+
+  return planner_strategy
+
+
+def make_highest_reward_strategy(scheduler):
+  """Makes a strategy that picks the action of highest immediate reward, or
+  that gets closest to the target if none reaches it."""
+  return make_planner_strategy(LookaheadPlanner(depth=1), scheduler)
 
 def make_greedy_strategy(get_q_values, verbose=False):
   """Makes greedy_strategy."""
@@ -137,9 +312,103 @@ def make_epsilon_greedy_strategy(get_q_values, epsilon):
 
   def epsilon_greedy_strategy(state, actions):
     """Picks random action with prob. epsilon, otherwise greedy_strategy."""
-    do_random_action = np.random.choice([True, False], p=[epsilon, 1 - epsilon])
-    if do_random_action:
+    if np.random.rand() < epsilon:
       return random_strategy(state, actions)
     return greedy_strategy(state, actions)
 
   return epsilon_greedy_strategy
+
+
+def batched_random_strategy(states, available_actions):
+  """Batched strategy that chooses a random available action for every state.
+
+  Args:
+    states: A (N, state_size) array of states.
+    available_actions: A (N, NUM_OF_ACTIONS) bool array, True where the action
+        is available from the state.
+
+  Returns:
+    A (N,) int array of actions.
+  """
+  scores = np.random.rand(*available_actions.shape)
+  scores[np.logical_not(available_actions)] = -1
+  return scores.argmax(axis=1)
+
+
+def make_batched_greedy_strategy(run_inference):
+  """Makes batched_greedy_strategy.
+
+  Args:
+    run_inference: function (state batch) -> Q-Value batch.
+  """
+
+  def batched_greedy_strategy(states, available_actions):
+    """Picks the available action of maximum Q(state, action) for every state,
+    with a single inference call for the whole batch."""
+    q_values = np.where(available_actions, run_inference(states), -np.inf)
+    return q_values.argmax(axis=1)
+
+  return batched_greedy_strategy
+
+
+def make_batched_epsilon_greedy_strategy(run_inference, epsilon):
+  """Makes batched_epsilon_greedy_strategy."""
+
+  batched_greedy_strategy = make_batched_greedy_strategy(run_inference)
+
+  def batched_epsilon_greedy_strategy(states, available_actions):
+    """Picks a random action with prob. epsilon for every state, otherwise the
+    batched_greedy_strategy action."""
+    do_random_action = np.random.rand(len(states)) < epsilon
+    if do_random_action.all():
+      return batched_random_strategy(states, available_actions)
+    actions = batched_greedy_strategy(states, available_actions)
+    actions[do_random_action] = batched_random_strategy(
+        states[do_random_action], available_actions[do_random_action])
+    return actions
+
+  return batched_epsilon_greedy_strategy
+
+
+def follow_batch(strategy, controller, num_steps):
+  """Drives all vehicles of a VectorVehicleController in lockstep.
+
+  Args:
+    strategy: A batched strategy, function (states, available_actions) ->
+        actions.
+    controller: A VectorVehicleController. Vehicles whose game ended or was
+        truncated are reset by the controller, so every step yields one
+        experience per vehicle.
+    num_steps: Number of steps to simulate.
+
+  Returns:
+    A dict of (N * num_steps, ...) arrays "states", "actions", "rewards",
+    "next_states", "game_over" and "truncated", which can be passed to
+    ReplayMemory.add_batch(). The num_steps experiences of every vehicle are
+    consecutive rows.
+  """
+  num_vehicles = controller.num_vehicles
+  available_actions = np.ones((num_vehicles, NUM_OF_ACTIONS), dtype=bool)
+  states = np.zeros((num_steps, num_vehicles, 4), dtype=np.float32)
+  actions = np.zeros((num_steps, num_vehicles), dtype=np.int32)
+  rewards = np.zeros((num_steps, num_vehicles), dtype=np.float32)
+  next_states = np.zeros((num_steps, num_vehicles, 4), dtype=np.float32)
+  game_over = np.zeros((num_steps, num_vehicles), dtype=bool)
+  truncated = np.zeros((num_steps, num_vehicles), dtype=bool)
+
+  state = controller.states()
+  for step in range(num_steps):
+    states[step] = state
+    actions[step] = strategy(state, available_actions)
+    (next_states[step], rewards[step], game_over[step],
+     truncated[step]) = controller.do_actions(actions[step])
+    state = controller.states()
+
+  # Vehicle-major rows keep the trajectory of every vehicle contiguous, as
+  # ReplayMemory.n_step_windows() expects.
+  return {"states": states.swapaxes(0, 1).reshape(-1, 4),
+          "actions": actions.T.ravel(),
+          "rewards": rewards.T.ravel(),
+          "next_states": next_states.swapaxes(0, 1).reshape(-1, 4),
+          "game_over": game_over.T.ravel(),
+          "truncated": truncated.T.ravel()}
@@ -0,0 +1,147 @@
+"""Prefetches batches on a background thread while the learner trains."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+import instrumentation
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+# Number of batches prepared ahead of the training step
+PREFETCH_DEPTH = 4
+
+# Seconds between checks whether a blocked producer has been stopped
+_POLL_SECONDS = 0.1
+
+_END = object()
+
+
+class _ProducerError(object):
+  """Wraps an exception raised while producing batches."""
+
+  def __init__(self, error):
+    self.error = error
+
+
+class BatchPrefetcher(object):
+  """Iterates over batches that a background thread prepares in advance.
+
+  The thread keeps up to depth batches in a bounded queue, so building the
+  next batches (sampling, batch assembly and target inference) overlaps with
+  the current training step. Counters tell which side waits for the other:
+  learner_starved counts the batches the learner had to wait for, and
+  producer_blocked counts the batches the producer could not hand over
+  because the queue was full.
+
+  Batches built in reused buffers must stay valid while queued: an
+  ExperienceBatcher needs num_buffer_sets >= depth + 2.
+  """
+
+  def __init__(self, batches, depth=PREFETCH_DEPTH):
+    """Init BatchPrefetcher and start the producer thread.
+
+    Args:
+      batches: Iterable of batches, e.g. ExperienceBatcher.get_batches().
+      depth: Maximum number of batches prepared ahead.
+    """
+    self.depth = depth
+    self._queue = queue.Queue(maxsize=depth)
+    self._stopped = False
+
+    self.produced = 0
+    self.consumed = 0
+    self.learner_starved = 0
+    self.learner_starved_seconds = 0.0
+    self.producer_blocked = 0
+    self.producer_blocked_seconds = 0.0
+
+    self._thread = threading.Thread(target=self._produce, args=(batches,))
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def _produce(self, batches):
+    """Producer thread: puts batches into the queue until stopped."""
+
+    try:
+      for batch in batches:
+        if not self._put(batch):
+          return
+        self.produced += 1
+        instrumentation.profile_thread()
+    except Exception as error:  # pylint: disable=broad-except
+      self._put(_ProducerError(error))
+      return
+    finally:
+      instrumentation.profile_thread(stop=True)
+    self._put(_END)
+
+
+  def _put(self, item):
+    """Puts item into the queue. Returns False if stopped while blocked."""
+
+    try:
+      self._queue.put_nowait(item)
+      return True
+    except queue.Full:
+      pass
+    self.producer_blocked += 1
+    start = time.time()
+    try:
+      while not self._stopped:
+        try:
+          self._queue.put(item, timeout=_POLL_SECONDS)
+          return True
+        except queue.Full:
+          instrumentation.profile_thread()
+      return False
+    finally:
+      self.producer_blocked_seconds += time.time() - start
+
+
+  def __iter__(self):
+    return self
+
+
+  def __next__(self):
+    try:
+      item = self._queue.get_nowait()
+    except queue.Empty:
+      self.learner_starved += 1
+      start = time.time()
+      item = self._queue.get()
+      self.learner_starved_seconds += time.time() - start
+
+    if item is _END:
+      raise StopIteration
+    if isinstance(item, _ProducerError):
+      raise item.error
+    self.consumed += 1
+    return item
+
+  next = __next__
+
+
+  def stop(self, timeout=None):
+    """Stops the producer thread, waiting at most timeout seconds for it."""
+
+    self._stopped = True
+    self._thread.join(timeout)
+
+
+  def print_stats(self):
+    """Print prefetch stats."""
+
+    print("Prefetch stats:")
+    print("  Batches          : ", self.consumed)
+    print("  Learner starved  : ", self.learner_starved,
+          "(%.1fs)" % self.learner_starved_seconds)
+    print("  Producer blocked : ", self.producer_blocked,
+          "(%.1fs)" % self.producer_blocked_seconds)
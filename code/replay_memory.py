@@ -4,48 +4,398 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import deque
-import random
+import json
+import os
+import threading
 
-MEMORY_CAPACITY = 1e4
+import numpy as np
+
+from play import Experience
+import sum_tree
+
+MEMORY_CAPACITY = int(1e4)
+
+# Shape of the stored experiences, must match the model.
+NUM_ELEMENTS_IN_STATE = 4
+NUM_ACTIONS = 16
+
+# Parameters for prioritized replay
+PRIORITY_ALPHA = 0.6
+PRIORITY_EPSILON = 1e-3
+PRIORITY_BETA_START = 0.4
+PRIORITY_BETA_SAMPLES = 1e6
+
+# File in a memory directory that stores size and write position
+METADATA_FILE = "memory.json"
 
 class ReplayMemory(object):
-  """Keeps a set of Experiences in a Queue"""
+  """Keeps a set of Experiences in a preallocated ring buffer.
+
+  Every field of an experience is stored in its own numpy column (states,
+  actions, rewards, next_states, game_over, truncated, not_available and
+  available_actions), so adding is a row assignment and sampling is a single
+  fancy indexing operation, independent of the capacity. Once the memory is
+  full, the oldest experiences are overwritten.
+
+  If a directory is given, the columns are memory-mapped .npy files in it, so
+  the memory can be larger than RAM and survives restarts: snapshot() writes
+  the size and write position next to the columns and a new ReplayMemory on
+  the same directory reopens them instead of starting empty.
+  """
+
+
+  def __init__(self, capacity=MEMORY_CAPACITY,
+               state_size=NUM_ELEMENTS_IN_STATE, num_actions=NUM_ACTIONS,
+               directory=None):
+    self.capacity = int(capacity)
+    self.directory = directory
+    # Number of stored experiences and index of the next one to write.
+    self.size = 0
+    self.position = 0
+    metadata = None
+    if directory is not None:
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      metadata_path = os.path.join(directory, METADATA_FILE)
+      if os.path.exists(metadata_path):
+        with open(metadata_path) as metadata_file:
+          metadata = json.load(metadata_file)
+        self.capacity = metadata["capacity"]
+        self.size = metadata["size"]
+        self.position = metadata["position"]
+    self._reopen = metadata is not None
+
+    self.states = self._allocate("states", (state_size,), np.float32)
+    self.actions = self._allocate("actions", (), np.int32)
+    self.rewards = self._allocate("rewards", (), np.float32)
+    self.next_states = self._allocate("next_states", (state_size,),
+                                      np.float32)
+    self.game_over = self._allocate("game_over", (), bool)
+    self.truncated = self._allocate("truncated", (), bool)
+    self.not_available = self._allocate("not_available", (), bool)
+    self.available_actions = self._allocate("available_actions",
+                                            (num_actions,), bool, True)
+
+
+  def _allocate(self, name, row_shape, dtype, fill=0):
+    """Returns a column with one row of <row_shape> per experience.
+
+    Without a directory, the column is an in-memory array. Otherwise it is
+    the memory-mapped file <directory>/<name>.npy, reopened if the memory
+    was snapshotted before.
+    """
+
+    shape = (self.capacity,) + row_shape
+    if self.directory is None:
+      return np.full(shape, fill, dtype=dtype)
+    path = os.path.join(self.directory, name + ".npy")
+    if self._reopen and os.path.exists(path):
+      return np.load(path, mmap_mode="r+")
+    column = np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                       shape=shape)
+    # New files read as zeros; writing zeros would dirty every page.
+    if fill:
+      column[:] = fill
+    return column
+
+
+  def metadata(self):
+    """Returns the capacity, size and position that snapshot() stores."""
+
+    return {"capacity": self.capacity, "size": self.size,
+            "position": self.position}
+
+
+  def snapshot(self, metadata=None):
+    """Flushes a memory-mapped memory to disk so that it can be reopened.
+
+    Experiences added after the last snapshot are not guaranteed to survive a
+    crash.
 
+    Args:
+      metadata: Optional metadata() taken earlier, e.g. when the snapshot is
+          written on another thread while experiences are still added. Rows
+          written since then hold newer experiences, which stay valid.
+    """
 
-  def __init__(self):
-    self.queue = deque()
+    if self.directory is None:
+      return
+    if metadata is None:
+      metadata = self.metadata()
+    for column in self._columns():
+      column.flush()
+    metadata_path = os.path.join(self.directory, METADATA_FILE)
+    with open(metadata_path + ".tmp", "w") as metadata_file:
+      json.dump(metadata, metadata_file)
+    os.rename(metadata_path + ".tmp", metadata_path)
+
+
+  def _columns(self):
+    """Returns all columns."""
+
+    return [self.states, self.actions, self.rewards, self.next_states,
+            self.game_over, self.truncated, self.not_available,
+            self.available_actions]
+
+
+  def __len__(self):
+    return self.size
 
 
   def add(self, experience):
-    """Add a single experience to queue."""
+    """Add a single experience, overwriting the oldest one when full."""
+
+    i = self.position
+    self.states[i] = np.ravel(experience.state)
+    self.actions[i] = experience.action
+    self.rewards[i] = experience.reward
+    self.next_states[i] = np.ravel(experience.next_state)
+    self.game_over[i] = experience.game_over
+    self.truncated[i] = experience.truncated
+    self.not_available[i] = experience.not_available
+    if experience.next_state_available_actions is None:
+      self.available_actions[i] = True
+    else:
+      self.available_actions[i] = False
+      self.available_actions[i, experience.next_state_available_actions] = True
+
+    self.position = (i + 1) % self.capacity
+    self.size = min(self.size + 1, self.capacity)
+
+
+  def add_batch(self, states, actions, rewards, next_states, game_over,
+                truncated=None, not_available=None, available_actions=None):
+    """Add a batch of experiences given as arrays with one row each.
+
+    Args:
+      states: A (count, state_size) array.
+      actions: A (count,) int array.
+      rewards: A (count,) float array.
+      next_states: A (count, state_size) array.
+      game_over: A (count,) bool array.
+      truncated: Optional (count,) bool array, defaults to False.
+      not_available: Optional (count,) bool array, defaults to False.
+      available_actions: Optional (count, num_actions) bool array of the
+          actions available from next_states, defaults to all actions.
 
-    self.queue.append(experience)
-    if len(self.queue) > MEMORY_CAPACITY:
-      self.queue.popleft()
+    Returns:
+      The (count,) array of memory indices the experiences were written to.
+    """
+
+    count = len(actions)
+    indices = (self.position + np.arange(count)) % self.capacity
+    self.states[indices] = states
+    self.actions[indices] = actions
+    self.rewards[indices] = rewards
+    self.next_states[indices] = next_states
+    self.game_over[indices] = game_over
+    self.truncated[indices] = False if truncated is None else truncated
+    self.not_available[indices] = (False if not_available is None
+                                   else not_available)
+    self.available_actions[indices] = (True if available_actions is None
+                                       else available_actions)
+
+    self.position = (self.position + count) % self.capacity
+    self.size = min(self.size + count, self.capacity)
+    return indices
 
 
   def print_stats(self):
     """Print memory stats."""
 
-    total = len(self.queue)
-    unavailable = len([1 for e in self.queue if e.not_available])
-    lost = len([1 for e in self.queue if e.game_over])
+    total = self.size
+    unavailable = np.count_nonzero(self.not_available[:total])
+    lost = np.count_nonzero(self.game_over[:total])
+    truncated = np.count_nonzero(self.truncated[:total])
 
     print("Memory stats:")
     print("  Experiences: ", total)
     print("  Unavailable: ", unavailable,
           "(%.1f%%)" % ((100 * unavailable / total),))
-    print("  Lost       : ", lost, "(%.1f%%)" % ((100 * lost / total),))
+    print("  Game over  : ", lost, "(%.1f%%)" % ((100 * lost / total),))
+    print("  Truncated  : ", truncated,
+          "(%.1f%%)" % ((100 * truncated / total),))
 
 
   def is_full(self):
     """Return whether the memory is full."""
 
-    return len(self.queue) >= MEMORY_CAPACITY
+    return self.size >= self.capacity
+
+
+  def sample_indices(self, count):
+    """Returns <count> uniformly drawn indices of stored experiences.
+
+    Indices are drawn with replacement, which keeps sampling O(count); for
+    batch sizes much smaller than the memory, duplicates are rare.
+    """
+
+    return np.random.randint(0, self.size, size=count)
+
+
+  def get(self, indices):
+    """Returns the experiences at <indices> as Experience instances.
+
+    The columns are gathered with fancy indexing, which copies, so the
+    experiences stay valid when their rows are overwritten.
+    """
+
+    indices = np.asarray(indices, dtype=np.int64)
+    states = self.states[indices]
+    actions = self.actions[indices]
+    rewards = self.rewards[indices]
+    next_states = self.next_states[indices]
+    game_over = self.game_over[indices]
+    not_available = self.not_available[indices]
+    available_actions = self.available_actions[indices]
+    truncated = self.truncated[indices]
+    return [Experience(states[i], actions[i], rewards[i], next_states[i],
+                       game_over[i], not_available[i],
+                       np.flatnonzero(available_actions[i]), truncated[i])
+            for i in range(len(indices))]
+
+
+  def n_step_windows(self, indices, num_steps):
+    """Finds the experiences that follow each of <indices> in its game.
+
+    Rows are written in the order games are played, but experiences dropped
+    by deduplication or games of interleaved actors break that order, so a
+    row only continues the previous one if its state is the previous
+    next_state. A window ends after an experience that ended or truncated the
+    game, and at the newest experience in the memory.
+
+    Args:
+      indices: (N,) memory indices of the first experiences.
+      num_steps: Maximum window length.
+
+    Returns:
+      rows, valid: (N, num_steps) arrays of the memory indices of the windows
+          and whether they belong to them. valid[:, 0] is always True and
+          valid is False after the first False of a row.
+    """
+
+    indices = np.asarray(indices)
+    offsets = np.arange(num_steps)
+    rows = (indices[:, np.newaxis] + offsets) % self.capacity
+    # Number of rows written after each index, wrapping around the ring.
+    newer = (self.position - 1 - indices) % self.capacity
+    valid = offsets <= newer[:, np.newaxis]
+    if num_steps > 1:
+      ended = (self.game_over[rows[:, :-1]] | self.truncated[rows[:, :-1]] |
+               self.not_available[rows[:, :-1]])
+      continues = np.all(self.states[rows[:, 1:]] ==
+                         self.next_states[rows[:, :-1]], axis=2)
+      valid[:, 1:] &= continues & np.logical_not(ended)
+    return rows, np.logical_and.accumulate(valid, axis=1)
 
 
   def sample(self, count):
     """Returns a random sample of <count> experiences."""
 
-    return random.sample(self.queue, count)
+    return self.get(self.sample_indices(count))
+
+
+  def importance_weights(self, indices):
+    """Returns the importance-sampling weights of sampled <indices>.
+
+    Uniform sampling needs no correction, so all weights are one.
+    """
+
+    return np.ones((len(indices),), dtype=np.float32)
+
+
+  def update_priorities(self, indices, td_errors):
+    """Updates the priorities of <indices>. Uniform sampling ignores them."""
+
+    pass
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+  """Replay memory that samples experiences proportional to their TD error.
+
+  Priorities (|td_error| + PRIORITY_EPSILON) ** PRIORITY_ALPHA are kept in a
+  SumTree, so sampling and updating a batch costs O(batch_size * log n). New
+  experiences get the maximum priority seen so far, so that each of them is
+  sampled at least once. The bias of the non-uniform sampling is corrected by
+  importance-sampling weights, whose exponent beta is annealed from
+  PRIORITY_BETA_START to 1 over PRIORITY_BETA_SAMPLES sampled batches.
+
+  The sum tree is guarded by a lock, so batches can be sampled on a prefetch
+  thread while the learner updates priorities.
+  """
+
+
+  def __init__(self, capacity=MEMORY_CAPACITY,
+               state_size=NUM_ELEMENTS_IN_STATE, num_actions=NUM_ACTIONS,
+               directory=None):
+    super(PrioritizedReplayMemory, self).__init__(capacity, state_size,
+                                                  num_actions, directory)
+    self.priorities = self._allocate("priorities", (), np.float64, 1.0)
+    self.tree = sum_tree.SumTree(self.capacity)
+    self._lock = threading.Lock()
+    self.tree.update(np.arange(self.size), self.priorities[:self.size])
+    self.max_priority = max(1.0, self.priorities[:self.size].max(initial=0))
+    self.beta = PRIORITY_BETA_START
+
+
+  def _columns(self):
+    """Returns all columns, including the priorities."""
+
+    return (super(PrioritizedReplayMemory, self)._columns() +
+            [self.priorities])
+
+
+  def add(self, experience):
+    """Add a single experience with maximum priority."""
+
+    with self._lock:
+      index = self.position
+      super(PrioritizedReplayMemory, self).add(experience)
+      self.priorities[index] = self.max_priority
+      self.tree.update([index], self.max_priority)
+
+
+  def add_batch(self, *args, **kwargs):
+    """Add a batch of experiences with maximum priority."""
+
+    with self._lock:
+      indices = super(PrioritizedReplayMemory, self).add_batch(*args,
+                                                               **kwargs)
+      self.priorities[indices] = self.max_priority
+      self.tree.update(indices, self.max_priority)
+    return indices
+
+
+  def sample_indices(self, count):
+    """Returns <count> indices drawn proportional to their priority.
+
+    The total priority is split into <count> equal segments and one index is
+    drawn from each of them, which reduces the variance of the batch.
+    """
+
+    with self._lock:
+      segment = self.tree.total() / count
+      values = (np.arange(count) + np.random.rand(count)) * segment
+      indices = self.tree.find_prefix_sum(values)
+    self.beta = min(1.0, self.beta +
+                    (1.0 - PRIORITY_BETA_START) / PRIORITY_BETA_SAMPLES)
+    return np.minimum(indices, self.size - 1)
+
+
+  def importance_weights(self, indices):
+    """Returns importance-sampling weights, normalized to a maximum of one."""
+
+    with self._lock:
+      probabilities = self.tree.get(indices) / self.tree.total()
+    weights = (self.size * probabilities) ** (-self.beta)
+    return (weights / weights.max()).astype(np.float32)
+
+
+  def update_priorities(self, indices, td_errors):
+    """Sets the priorities of <indices> from their latest TD errors."""
+
+    priorities = (np.abs(td_errors) + PRIORITY_EPSILON) ** PRIORITY_ALPHA
+    with self._lock:
+      self.priorities[indices] = priorities
+      self.tree.update(indices, priorities)
+      self.max_priority = max(self.max_priority, priorities.max())
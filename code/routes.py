@@ -0,0 +1,354 @@
+"""Routes read from odometry logs, for use as game targets."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import os
+
+import numpy as np
+
+from instrumentation import logger, timers
+import vehicle
+
+# Odometry log with x, y, steering and heading columns
+ODOMETRY_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "odom_simplified.csv")
+
+# Columns of the pose arrays, looked up by name in the CSV header
+POSE_COLUMNS = ("x", "y", "steering", "heading")
+
+# Number of CSV rows parsed at once
+CSV_CHUNK_ROWS = 1 << 16
+
+# Suffix of the binary sidecar that caches the parsed poses of a CSV
+SIDECAR_SUFFIX = ".poses.npy"
+
+# Distance (meters) between two consecutive waypoints of a route
+WAYPOINT_SPACING = 1.0
+
+# Number of waypoints between the start and the target of route games
+WAYPOINT_LOOKAHEAD = 5
+
+# Edge length (meters) of the grid cells of WaypointGrid
+GRID_CELL_SIZE = 2.0
+
+# Maximum number of waypoints a RouteTracker skips at once, so that routes
+# crossing themselves do not skip to a much later pass of the same spot
+MAX_SKIPPED_WAYPOINTS = 10
+
+
+def count_rows(path, block_size=1 << 24):
+  """Returns the number of non-empty lines after the header of a CSV file.
+
+  Lines holding only whitespace count as empty, as in iter_pose_chunks().
+  """
+
+  rows = 0
+  with open(path, "rb") as csv_file:
+    csv_file.readline()
+    tail = b""
+    for block in iter(lambda: csv_file.read(block_size), b""):
+      lines = (tail + block).split(b"\n")
+      # The last piece may continue in the next block.
+      tail = lines.pop()
+      rows += sum(1 for line in lines if line.strip())
+  if tail.strip():
+    rows += 1
+  return rows
+
+
+def iter_pose_chunks(path, chunk_rows=CSV_CHUNK_ROWS):
+  """Yields the poses of an odometry CSV in (N, 4) float64 chunks.
+
+  Only chunk_rows lines are held in memory at a time. The columns are
+  reordered to POSE_COLUMNS according to the header.
+  """
+
+  with open(path) as csv_file:
+    header = [name.strip() for name in csv_file.readline().split(",")]
+    try:
+      order = [header.index(name) for name in POSE_COLUMNS]
+    except ValueError:
+      raise ValueError("%s: expected columns %s, got %s" %
+                       (path, POSE_COLUMNS, header))
+    while True:
+      lines = [line for line in itertools.islice(csv_file, chunk_rows)
+               if line.strip()]
+      if not lines:
+        break
+      chunk = np.loadtxt(lines, delimiter=",", dtype=np.float64, ndmin=2)
+      yield chunk[:, order]
+
+
+def load_poses(path=ODOMETRY_CSV, refresh=False):
+  """Returns the (N, 4) poses of an odometry CSV as a memory-mapped array.
+
+  The poses are cached in a .npy sidecar next to the CSV. The sidecar is
+  (re)built when it is missing, older than the CSV or refresh is set, by
+  streaming the CSV into it chunk by chunk.
+  """
+
+  sidecar = path + SIDECAR_SUFFIX
+  if (refresh or not os.path.exists(sidecar) or
+      os.path.getmtime(sidecar) < os.path.getmtime(path)):
+    with timers.timer("parse_odometry"):
+      num_rows = count_rows(path)
+      temp_path = sidecar + ".tmp.npy"
+      poses = np.lib.format.open_memmap(temp_path, mode="w+",
+                                        dtype=np.float64,
+                                        shape=(num_rows, len(POSE_COLUMNS)))
+      offset = 0
+      for chunk in iter_pose_chunks(path):
+        poses[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+      poses.flush()
+      del poses
+      if offset != num_rows:
+        os.remove(temp_path)
+        raise ValueError("%s: counted %d rows, parsed %d" %
+                         (path, num_rows, offset))
+      os.rename(temp_path, sidecar)
+    logger.info("Parsed %d poses from %s", num_rows, path)
+  return np.load(sidecar, mmap_mode="r")
+
+
+def waypoint_indices(poses, spacing=WAYPOINT_SPACING):
+  """Returns the indices of poses that are spaced about <spacing> apart along
+  the driven path, always including the first and last pose."""
+
+  steps = np.hypot(np.diff(poses[:, 0]), np.diff(poses[:, 1]))
+  distance = np.concatenate([[0.0], np.cumsum(steps)])
+  cells = np.floor(distance / spacing).astype(np.int64)
+  indices = np.flatnonzero(np.diff(cells, prepend=-1))
+  if indices[-1] != len(poses) - 1:
+    indices = np.append(indices, len(poses) - 1)
+  return indices
+
+
+class Route(object):
+  """A sequence of waypoints [x, y, steering, heading] to drive through."""
+
+  def __init__(self, waypoints):
+    """Init Route.
+
+    Args:
+      waypoints: (N, 4) array of waypoints in driving order.
+    """
+    self.waypoints = np.asarray(waypoints, dtype=np.float64)
+
+
+  @classmethod
+  def from_poses(cls, poses, spacing=WAYPOINT_SPACING):
+    """Makes a Route of the poses of a log, spaced <spacing> meters apart."""
+
+    return cls(poses[waypoint_indices(poses, spacing)])
+
+
+  @classmethod
+  def from_csv(cls, path=ODOMETRY_CSV, spacing=WAYPOINT_SPACING):
+    """Makes a Route of an odometry CSV, see load_poses()."""
+
+    return cls.from_poses(load_poses(path), spacing)
+
+
+  def __len__(self):
+    return len(self.waypoints)
+
+
+  def __getitem__(self, index):
+    return self.waypoints[index]
+
+
+  def target(self, index):
+    """Returns waypoint <index> as a list, as Vehicle_Controller takes it."""
+
+    return self.waypoints[index].tolist()
+
+
+  def make_episode_source(self, lookahead=WAYPOINT_LOOKAHEAD):
+    """Makes an episode_source for EpisodeScheduler.
+
+    Every game starts at a random waypoint with the waypoint <lookahead>
+    further along the route as its target.
+    """
+
+    lookahead = min(lookahead, len(self) - 1)
+    def route_episode():
+      """Returns a random waypoint and the one lookahead further."""
+      start = np.random.randint(len(self) - lookahead)
+      return self.target(start), self.target(start + lookahead)
+    return route_episode
+
+
+class WaypointGrid(object):
+  """Uniform grid over the x, y positions of waypoints for nearest queries.
+
+  Waypoints are sorted by grid cell. Only occupied cells are stored, as the
+  sorted keys cell_keys with the range cell_starts[i]:cell_ends[i] of their
+  waypoints in the sorted order, so memory grows with the number of
+  waypoints and not with the area of the route. A query only measures
+  the waypoints in the 3x3 cells around it, so its cost depends on the
+  waypoint density instead of the route length. Queries farther than
+  cell_size from every waypoint either fall back to measuring all waypoints
+  or, with exhaustive=False, get no result.
+  """
+
+  def __init__(self, positions, cell_size=GRID_CELL_SIZE):
+    """Init WaypointGrid.
+
+    Args:
+      positions: (N, 2) array of waypoint x, y.
+      cell_size: Edge length of the grid cells in meters.
+    """
+    self.positions = np.asarray(positions, dtype=np.float64)
+    self.cell_size = cell_size
+    self.origin = self.positions.min(axis=0)
+    cells = self._cells(self.positions)
+    self.shape = cells.max(axis=0) + 1
+    flat_cells = cells[:, 0] * self.shape[1] + cells[:, 1]
+    self.order = np.argsort(flat_cells, kind="stable")
+    self.cell_keys, self.cell_starts = np.unique(flat_cells[self.order],
+                                                 return_index=True)
+    self.cell_ends = np.append(self.cell_starts[1:], len(flat_cells))
+
+
+  def _cells(self, positions):
+    """Returns the (N, 2) integer grid cells of (N, 2) positions."""
+
+    return np.floor((positions - self.origin) /
+                    self.cell_size).astype(np.int64)
+
+
+  def nearest(self, positions, exhaustive=True):
+    """Finds the nearest waypoint of each of (M, 2) positions.
+
+    Args:
+      positions: (M, 2) array of x, y.
+      exhaustive: Whether queries farther than cell_size from every waypoint
+          measure all waypoints, which costs O(N) each. If False, they get
+          index -1 and distance inf, so the cost does not depend on the route
+          length.
+
+    Returns:
+      indices, distances: (M,) arrays of waypoint indices and distances.
+    """
+
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    num_queries = len(positions)
+    cells = self._cells(positions)
+
+    # All (query, neighbor cell) pairs inside the grid.
+    offsets = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    pair_cells = (cells[:, np.newaxis, :] + offsets).reshape(-1, 2)
+    pair_queries = np.repeat(np.arange(num_queries), len(offsets))
+    inside = np.all((pair_cells >= 0) & (pair_cells < self.shape), axis=1)
+    pair_cells = pair_cells[inside]
+    pair_queries = pair_queries[inside]
+    flat_cells = pair_cells[:, 0] * self.shape[1] + pair_cells[:, 1]
+    slots = np.minimum(np.searchsorted(self.cell_keys, flat_cells),
+                       len(self.cell_keys) - 1)
+    occupied = self.cell_keys[slots] == flat_cells
+    starts = self.cell_starts[slots]
+    counts = np.where(occupied, self.cell_ends[slots] - starts, 0)
+
+    # Flattened candidate waypoints of all pairs.
+    candidate_queries = np.repeat(pair_queries, counts)
+    run_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+                                                      counts, counts)
+    candidates = self.order[np.repeat(starts, counts) + run_offsets]
+    squared = ((self.positions[candidates] -
+                positions[candidate_queries]) ** 2).sum(axis=1)
+
+    indices = np.full((num_queries,), -1, dtype=np.int64)
+    distances = np.full((num_queries,), np.inf)
+    order = np.lexsort((squared, candidate_queries))
+    queries, first = np.unique(candidate_queries[order], return_index=True)
+    indices[queries] = candidates[order[first]]
+    distances[queries] = np.sqrt(squared[order[first]])
+
+    # Beyond cell_size, a nearer waypoint may lie outside the 3x3 cells.
+    far = np.flatnonzero(distances > self.cell_size)
+    if not exhaustive:
+      indices[far] = -1
+      distances[far] = np.inf
+      return indices, distances
+    for query in far:
+      squared = ((self.positions - positions[query]) ** 2).sum(axis=1)
+      indices[query] = squared.argmin()
+      distances[query] = np.sqrt(squared[indices[query]])
+    return indices, distances
+
+
+class RouteTracker(object):
+  """Tracks the progress of vehicles driving along a Route.
+
+  Every vehicle targets the waypoint at its progress index and moves on to
+  the next one when goals_reached() holds for it. A vehicle that passes
+  within the position tolerance of a later waypoint skips ahead to it, found
+  with a WaypointGrid (by at most MAX_SKIPPED_WAYPOINTS), so progress is not
+  lost when a waypoint is missed. Progress only moves forward. The grid is
+  queried without the exhaustive fallback, so the cost of update() does not
+  grow with the route length; cell_size must not be below the position
+  tolerance.
+  """
+
+  def __init__(self, route, num_vehicles=1, cell_size=GRID_CELL_SIZE):
+    """Init RouteTracker.
+
+    Args:
+      route: The Route to follow.
+      num_vehicles: Number of vehicles tracked at once.
+      cell_size: Cell size of the WaypointGrid, at least the position
+          tolerance GOAL_TOLERANCES[0].
+    """
+    if cell_size < vehicle.GOAL_TOLERANCES[0]:
+      raise ValueError("cell_size %s is below the position tolerance %s" %
+                       (cell_size, vehicle.GOAL_TOLERANCES[0]))
+    self.route = route
+    self.grid = WaypointGrid(route.waypoints[:, :2], cell_size)
+    self.progress = np.zeros((num_vehicles,), dtype=np.int64)
+
+
+  def reset(self, indices=None, progress=0):
+    """Restarts the vehicles at <indices> (default all) at waypoint
+    <progress>."""
+
+    if indices is None:
+      indices = slice(None)
+    self.progress[indices] = progress
+
+
+  def finished(self):
+    """Returns a (N,) bool array, True for vehicles past the last waypoint."""
+
+    return self.progress >= len(self.route)
+
+
+  def target_states(self):
+    """Returns the (N, 4) current target waypoints, the last one for
+    finished vehicles."""
+
+    return self.route.waypoints[np.minimum(self.progress,
+                                           len(self.route) - 1)]
+
+
+  def update(self, states):
+    """Advances the progress of the vehicles at (N, 4) states.
+
+    Returns:
+      A (N,) bool array, True for vehicles that reached their target waypoint
+      in this step.
+    """
+
+    states = np.asarray(states, dtype=np.float64).reshape(-1, 4)
+    active = np.logical_not(self.finished())
+    reached = active & vehicle.goals_reached(states, self.target_states())
+    self.progress[reached] += 1
+    nearest, distances = self.grid.nearest(states[:, :2], exhaustive=False)
+    ahead = nearest - self.progress
+    skipped = (active & (ahead > 0) & (ahead <= MAX_SKIPPED_WAYPOINTS) &
+               (distances <= vehicle.GOAL_TOLERANCES[0]))
+    self.progress[skipped] = nearest[skipped]
+    return reached
@@ -0,0 +1,68 @@
+"""Sum tree for proportional sampling of prioritized experiences."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class SumTree(object):
+  """Binary tree whose inner nodes store the sum of their children.
+
+  The tree is kept in a flat array: node i has the children 2i and 2i + 1 and
+  the leaves start at index self.num_leaves. Updates and prefix sum lookups
+  take O(log n) and are vectorized over batches of indices.
+  """
+
+  def __init__(self, capacity):
+    """Init SumTree.
+
+    Args:
+      capacity: Number of leaves needed. Rounded up to a power of two.
+    """
+    self.capacity = int(capacity)
+    self.depth = max(1, int(np.ceil(np.log2(max(self.capacity, 2)))))
+    self.num_leaves = 2 ** self.depth
+    self.tree = np.zeros((2 * self.num_leaves,), dtype=np.float64)
+
+
+  def total(self):
+    """Return the sum of all leaves."""
+
+    return self.tree[1]
+
+
+  def get(self, indices):
+    """Return the values of the leaves at <indices>."""
+
+    return self.tree[np.asarray(indices) + self.num_leaves]
+
+
+  def update(self, indices, values):
+    """Set the leaves at <indices> to <values> and update their ancestors."""
+
+    nodes = np.asarray(indices, dtype=np.int64) + self.num_leaves
+    self.tree[nodes] = values
+    for _ in range(self.depth):
+      nodes = np.unique(nodes // 2)
+      self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+
+  def find_prefix_sum(self, values):
+    """Returns for each value the leaf where the running sum exceeds it.
+
+    Args:
+      values: A (count,) float array with values in [0, total()).
+
+    Returns:
+      A (count,) int array of leaf indices.
+    """
+    values = np.array(values, dtype=np.float64)
+    nodes = np.ones(values.shape, dtype=np.int64)
+    for _ in range(self.depth):
+      left = self.tree[2 * nodes]
+      go_right = values >= left
+      values -= left * go_right
+      nodes = 2 * nodes + go_right
+    return nodes - self.num_leaves
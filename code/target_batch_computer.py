@@ -8,10 +8,35 @@ import numpy as np
 
 
 GAMMA = 0.5
-MERGED_REWARD_FACTOR = 1.0
+# Games end when the target is reached, so a per-step reward for staying in
+# the game would teach the vehicle to avoid its target.
+MERGED_REWARD_FACTOR = 0.0
 LOST_REWARD = 0.0
 
 
+def n_step_returns(reward_windows, valid, gamma=GAMMA):
+  """Discounts reward windows, e.g. from ReplayMemory.n_step_windows().
+
+  Args:
+    reward_windows: A (batch_size, num_steps) float array of the rewards of
+        consecutive experiences.
+    valid: A (batch_size, num_steps) bool array, whether the experiences
+        belong to the window. False after the first False of a row.
+    gamma: The discount factor.
+
+  Returns:
+    returns, num_steps, discounts: (batch_size,) arrays of the discounted sums
+        of the valid rewards, the window lengths and gamma ** num_steps, the
+        discount of the Q-Value bootstrapped after the window.
+  """
+
+  powers = gamma ** np.arange(reward_windows.shape[1], dtype=np.float32)
+  returns = (reward_windows * powers * valid).sum(axis=1, dtype=np.float32)
+  num_steps = valid.sum(axis=1)
+  discounts = (gamma ** num_steps).astype(np.float32)
+  return returns, num_steps, discounts
+
+
 class TargetBatchComputer(object):
   """Computes the target batch for the neural network."""
 
@@ -25,14 +50,15 @@ class TargetBatchComputer(object):
 
 
   def compute(self, reward_batch, bad_action_batch, next_state_batch,
-              available_actions_batch, merged):
+              available_actions_batch, merged, discounts=None):
     """Computes the target batch for the neural network.
 
     Args:
       reward_batch: A (batch_size,) float numpy array containing the rewards from
           the game associated with the experiences in the batch.
       bad_action_batch: A (batch_size,) bool numpy array containing whether the
-          respective experience was "bad" (i.e. lost the game).
+          respective experience ended the game (target reached or lost). Its
+          target is not bootstrapped. Truncated games are not "bad".
       next_state_batch: A (batch_size, 16) float numpy array where each row
           contains the next state associated with the experience. The values MUST
           be already in the right scale so that they can be passed directly to
@@ -41,6 +67,10 @@ class TargetBatchComputer(object):
           actions are available from the next state.
       merged: A (batch_size,) float numpy array that contains how many tiles
           have been merged at tha current experience.
+      discounts: Optional (batch_size,) float numpy array with the discount of
+          the bootstrapped Q-Value of every experience, e.g. from
+          n_step_returns() where reward_batch holds n-step returns. Defaults
+          to GAMMA.
 
     Returns:
       A (batch_size,) float numpy array that contains the target values for the
@@ -48,13 +78,14 @@ class TargetBatchComputer(object):
     """
 
     (batch_size,) = reward_batch.shape
-    targets = np.zeros((batch_size,), dtype=np.float)
+    targets = np.zeros((batch_size,), dtype=np.float32)
 
     good_action_batch = np.logical_not(bad_action_batch)
 
     targets[bad_action_batch] = LOST_REWARD
     targets[good_action_batch] = (merged[good_action_batch] *
                                   MERGED_REWARD_FACTOR)
+    targets += reward_batch
 
     if GAMMA > 0:
       predictions = self.run_inference(next_state_batch)
@@ -62,6 +93,10 @@ class TargetBatchComputer(object):
       predictions[np.logical_not(available_actions_batch)] = -1e8
       max_qs = predictions.max(axis=1)
       max_qs = np.maximum(max_qs, -1)
-      targets[good_action_batch] += GAMMA * max_qs[good_action_batch]
+      if discounts is None:
+        targets[good_action_batch] += GAMMA * max_qs[good_action_batch]
+      else:
+        targets[good_action_batch] += (discounts[good_action_batch] *
+                                       max_qs[good_action_batch])
 
     return targets
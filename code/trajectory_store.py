@@ -0,0 +1,206 @@
+"""Columnar on-disk recording of played games for offline training."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import threading
+
+import numpy as np
+
+# Number of experiences per shard
+SHARD_SIZE = 65536
+
+# File that lists the shards and the episode offsets
+INDEX_FILE = "index.json"
+
+# Columns of a recording, as produced by play.experiences_to_columns()
+COLUMNS = ("states", "actions", "rewards", "next_states", "game_over",
+           "truncated", "not_available")
+
+
+class TrajectoryWriter(object):
+  """Appends experiences to a directory of columnar shards.
+
+  Every shard stores each column as its own .npy file
+  (<directory>/shard_<n>.<column>.npy), so readers can memory-map single
+  columns. The index records the size of every shard and the offsets at
+  which episodes start; an episode ends with an experience that has
+  game_over or truncated set. Only offsets of written experiences are
+  stored, so a recording reopened after a stop without flush() continues
+  after its last shard. append() and flush() may be called from different
+  threads.
+  """
+
+  def __init__(self, directory, shard_size=SHARD_SIZE):
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.shard_size = shard_size
+    self._lock = threading.Lock()
+    self._index = {"shards": [], "episode_offsets": [0]}
+    index_path = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(index_path):
+      with open(index_path) as index_file:
+        self._index = json.load(index_file)
+    self.num_experiences = sum(self._index["shards"])
+    # Indexes written by older versions may list unwritten experiences.
+    self._index["episode_offsets"] = [
+        offset for offset in self._index["episode_offsets"]
+        if offset <= self.num_experiences]
+    self._pending = []
+    self._num_pending = 0
+    self._pending_offsets = []
+
+
+  def append(self, columns):
+    """Appends a dict of column arrays, see play.experiences_to_columns()."""
+
+    count = len(columns["actions"])
+    if not count:
+      return
+    ends = np.flatnonzero(np.logical_or(columns["game_over"],
+                                        columns["truncated"]))
+    with self._lock:
+      offset = self.num_experiences + self._num_pending
+      self._pending_offsets.extend((offset + ends + 1).tolist())
+      self._pending.append(columns)
+      self._num_pending += count
+      while self._num_pending >= self.shard_size:
+        self._write_shard(self.shard_size)
+
+
+  def _write_shard(self, count):
+    """Writes the first <count> pending experiences as a new shard. Must be
+    called with the lock held."""
+
+    merged = {name: np.concatenate([columns[name]
+                                    for columns in self._pending])
+              for name in COLUMNS}
+    shard = len(self._index["shards"])
+    for name in COLUMNS:
+      np.save(self._shard_path(self.directory, shard, name),
+              merged[name][:count])
+    self._index["shards"].append(count)
+    self.num_experiences += count
+    self._num_pending -= count
+    self._pending = ([{name: merged[name][count:] for name in COLUMNS}]
+                     if self._num_pending else [])
+    written = [offset for offset in self._pending_offsets
+               if offset <= self.num_experiences]
+    self._pending_offsets = self._pending_offsets[len(written):]
+    self._index["episode_offsets"].extend(written)
+    self._write_index()
+
+
+  def _write_index(self):
+    """Atomically replaces the index file."""
+
+    index_path = os.path.join(self.directory, INDEX_FILE)
+    with open(index_path + ".tmp", "w") as index_file:
+      json.dump(self._index, index_file)
+    os.rename(index_path + ".tmp", index_path)
+
+
+  def flush(self):
+    """Writes the pending experiences as a smaller shard. Appending can
+    continue afterwards."""
+
+    with self._lock:
+      if self._num_pending:
+        self._write_shard(self._num_pending)
+
+
+  @staticmethod
+  def _shard_path(directory, shard, name):
+    return os.path.join(directory, "shard_%05d.%s.npy" % (shard, name))
+
+
+class TrajectoryReader(object):
+  """Reads a directory written by TrajectoryWriter.
+
+  Shards are memory-mapped, so reading is a sequential scan of the files
+  and only the touched pages are loaded.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    with open(os.path.join(directory, INDEX_FILE)) as index_file:
+      index = json.load(index_file)
+    self.shard_sizes = index["shards"]
+    self.shard_offsets = np.concatenate([[0], np.cumsum(self.shard_sizes)])
+    self.num_experiences = int(self.shard_offsets[-1])
+    offsets = np.array(index["episode_offsets"], dtype=np.int64)
+    # Offsets of episodes that are fully written, plus the end.
+    self.episode_offsets = offsets[offsets <= self.num_experiences]
+
+
+  def __len__(self):
+    return self.num_experiences
+
+
+  def num_episodes(self):
+    """Returns the number of complete episodes."""
+
+    return len(self.episode_offsets) - 1
+
+
+  def shard(self, shard):
+    """Returns the columns of a shard as memory-mapped arrays."""
+
+    return {name: np.load(TrajectoryWriter._shard_path(self.directory, shard,
+                                                       name),
+                          mmap_mode="r")
+            for name in COLUMNS}
+
+
+  def read(self, start, stop):
+    """Returns the columns of experiences [start, stop) as arrays."""
+
+    parts = []
+    first = np.searchsorted(self.shard_offsets, start, side="right") - 1
+    for shard in range(max(first, 0), len(self.shard_sizes)):
+      shard_start = self.shard_offsets[shard]
+      if shard_start >= stop:
+        break
+      columns = self.shard(shard)
+      begin = max(start - shard_start, 0)
+      end = min(stop - shard_start, self.shard_sizes[shard])
+      parts.append({name: columns[name][begin:end] for name in COLUMNS})
+    return {name: np.concatenate([part[name] for part in parts])
+            for name in COLUMNS}
+
+
+  def episode(self, episode):
+    """Returns the columns of the episode with the given index."""
+
+    return self.read(self.episode_offsets[episode],
+                     self.episode_offsets[episode + 1])
+
+
+  def iter_chunks(self, chunk_size=SHARD_SIZE):
+    """Yields the recording in order as column dicts of chunk_size rows."""
+
+    for start in range(0, self.num_experiences, chunk_size):
+      yield self.read(start, min(start + chunk_size, self.num_experiences))
+
+
+  def load_into(self, memory, limit=None, chunk_size=SHARD_SIZE):
+    """Adds the (last <limit>) recorded experiences to a ReplayMemory.
+
+    Returns:
+      Number of experiences added.
+    """
+
+    start = 0
+    if limit is not None:
+      start = max(self.num_experiences - limit, 0)
+    added = 0
+    for chunk_start in range(start, self.num_experiences, chunk_size):
+      columns = self.read(chunk_start, min(chunk_start + chunk_size,
+                                           self.num_experiences))
+      memory.add_batch(**columns)
+      added += len(columns["actions"])
+    return added
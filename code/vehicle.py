@@ -2,8 +2,8 @@
 
 import numpy as np
 from random import uniform
-import time, math
-import matplotlib.pyplot as plt
+import time, math, copy
+from instrumentation import logger
 
 # The vehicle moves every time with a constant velocity.
 # Defined actions:
@@ -43,23 +43,139 @@ SMALL = 1e-8
 INCHES2METERS = 25.4/1000.0
 VEHICLEWHEEL2WHEELLENGTH = 72*INCHES2METERS
 
+# Steering angle commanded by every action: the raw sensor value 100 maps to
+# +pi/4 and 400 maps to -pi/4.
+STEERING_ANGLES = np.array([(math.pi/4) + ((int(name)-100)/(400-100))*(-math.pi/2)
+                            for name in ACTION_NAMES])
+
+# Tolerances of the goal test for [x, y, steering, heading].
+GOAL_TOLERANCES = np.array([1, 1, 0.1, 0.1])
+
+# Timestep (in seconds) of simulated time per step.
+SIMULATION_TIMESTEP = 0.1
+
+# Episode bounds: games are truncated after MAX_EPISODE_STEPS actions and
+# lost when the vehicle leaves the square |x|, |y| <= POSITION_BOUND.
+MAX_EPISODE_STEPS = 1000
+POSITION_BOUND = 100.0
+
+# Maximum number of timesteps motion_table() keeps tables for
+MAX_CACHED_MOTION_TABLES = 16
+
+
+def action_motion(action, deltaT):
+  """Computes the motion of the vehicle in its own frame for one action.
+
+  The bicycle model drives along an arc around the center of the back
+  wheels. In the vehicle frame (x forward, y left) the resulting motion only
+  depends on the action and deltaT, not on the pose.
+
+  Returns:
+    local_dx, local_dy, delta_heading, steering.
+  """
+  steering = STEERING_ANGLES[action]
+  if (steering > ACT_STEERING_MAX_ANGLE_RANGE / 2):
+      steering = ACT_STEERING_MAX_ANGLE_RANGE / 2
+  if (steering < -ACT_STEERING_MAX_ANGLE_RANGE / 2):
+      steering = -ACT_STEERING_MAX_ANGLE_RANGE / 2
+
+  tan_steer = math.tan(steering)
+  if (abs(tan_steer) < SMALL):
+      tan_steer = SMALL
+
+  backradius = VEHICLEWHEEL2WHEELLENGTH/tan_steer
+  deltalength = velocity*deltaT
+  delta_arc_angle = deltalength / backradius
+  local_dx = backradius*math.sin(delta_arc_angle)
+  local_dy = backradius*(1 - math.cos(delta_arc_angle))
+  return local_dx, local_dy, delta_arc_angle, steering
+
+
+def build_motion_table(deltaT):
+  """Returns a (NUM_OF_ACTIONS, 4) array whose rows are action_motion()."""
+  return np.array([action_motion(action, deltaT)
+                   for action in range(NUM_OF_ACTIONS)])
+
+
+_motion_tables = {}
+
+
+def motion_table(deltaT):
+  """Returns build_motion_table(deltaT), computing it once per timestep."""
+  table = _motion_tables.get(deltaT)
+  if table is None:
+    table = build_motion_table(deltaT)
+    if len(_motion_tables) < MAX_CACHED_MOTION_TABLES:
+      _motion_tables[deltaT] = table
+  return table
+
+
+class SimulationClock(object):
+  """Clock that advances by a fixed timestep per tick, decoupled from wall time.
+
+  Trajectories driven by this clock are reproducible and the simulation can
+  run as fast as the host allows.
+  """
+
+  # Every tick has the same duration, so motion_table() applies.
+  fixed_timestep = True
+
+  def __init__(self, dt=SIMULATION_TIMESTEP):
+    self.dt = dt
+    self._now = 0.0
+
+  def now(self):
+    """Return the simulated time in seconds."""
+    return self._now
+
+  def tick(self):
+    """Advance the clock by one step and return the elapsed time."""
+    self._now += self.dt
+    return self.dt
+
+
+class RealTimeClock(object):
+  """Clock that measures wall time between ticks, for the hardware loop."""
+
+  fixed_timestep = False
+
+  def __init__(self):
+    self._last_update_time = time.time()
+
+  def now(self):
+    """Return the wall time in seconds."""
+    return time.time()
+
+  def tick(self):
+    """Return the wall time elapsed since the previous tick."""
+    time_now = time.time()
+    elapsed = time_now - self._last_update_time
+    self._last_update_time = time_now
+    return elapsed
+
 class Vehicle_Controller(object):
-  """ Initializes the Vehicle controller object"""
-  def __init__(self, state, target_state , stop_simulation):
-    print ("Vehicle Controller Object is created with state: ", state, "and target state: ", target_state)
+  """ Initializes the Vehicle controller object
+
+  The clock decides how much time passes with every action: a RealTimeClock
+  (the default) for the hardware loop, or a SimulationClock for training.
+  """
+  def __init__(self, state, target_state , stop_simulation, clock=None):
+    logger.debug("Vehicle Controller Object is created with state: %s and "
+                 "target state: %s", state, target_state)
     self._target_state = target_state
     self.stop_simulation = stop_simulation
+    self.clock = clock if clock is not None else RealTimeClock()
     if state is None and target_state is None:
         self._state = [0, 0, 0, 0]
         self.add_random_point_to_follow()
     else:
         self._state = state
         self._target_state = target_state
-        self.LastUpdateTime = time.time()
 
   def copy(self):
     """Return a copy of self."""
-    return Vehicle_Controller(np.copy(self._state), self._target_state, self.stop_simulation)
+    return Vehicle_Controller(np.copy(self._state), self._target_state,
+                              self.stop_simulation, copy.copy(self.clock))
 
   def simulation_over(self):
     """Whether the simulation is over."""
@@ -71,51 +187,34 @@ class Vehicle_Controller(object):
   def do_action(self, action):
     """ performs action on the current state. """
     reward = 0
-    temp_state = self._state
-    print("Current state" ,temp_state)
-    print(action)
-    steer_action = (math.pi/4) + ((int(ACTION_NAMES[action])-100)/(400-100))*(-math.pi/2)
-    timeNow = time.time()
-    deltaT = timeNow - self.LastUpdateTime
-
-    steering = temp_state[2] + action
-
-    if (steering > ACT_STEERING_MAX_ANGLE_RANGE / 2):
-        temp_state[2]= ACT_STEERING_MAX_ANGLE_RANGE / 2
-    if (steering < -ACT_STEERING_MAX_ANGLE_RANGE / 2):
-        temp_state[2] = -ACT_STEERING_MAX_ANGLE_RANGE / 2
-
-    tan_steer = math.tan(steering)
-    if (abs(tan_steer) < SMALL):
-    	tan_steer = SMALL
-
-    sin_steer = math.sin(steering);
-    if (abs(sin_steer) < SMALL):
-    	sin_steer = SMALL;
-
-    backradius = VEHICLEWHEEL2WHEELLENGTH/tan_steer
-    deltalength = velocity*deltaT
-    delta_arc_angle = deltalength / backradius
-    centerx = temp_state[0] - math.sin(temp_state[3])*backradius
-    centery = temp_state[1] + math.cos(temp_state[3])*backradius
-
-    new_heading = temp_state[3] + delta_arc_angle
-    temp_state[0] = centerx + math.sin(new_heading)*backradius
-    temp_state[1] = centery - math.cos(new_heading)*backradius
+    # Work on a copy so that states handed out earlier are not modified.
+    temp_state = list(self._state)
+    logger.debug("Current state %s, action %s", temp_state, action)
+    deltaT = self.clock.tick()
+    if self.clock.fixed_timestep:
+      local_dx, local_dy, delta_heading, steering = motion_table(deltaT)[action]
+    else:
+      local_dx, local_dy, delta_heading, steering = action_motion(action, deltaT)
+    temp_state[2] = steering
+
+    # Rotate the motion from the vehicle frame into the world frame.
+    cos_heading = math.cos(temp_state[3])
+    sin_heading = math.sin(temp_state[3])
+    temp_state[0] += cos_heading*local_dx - sin_heading*local_dy
+    temp_state[1] += sin_heading*local_dx + cos_heading*local_dy
 
+    new_heading = temp_state[3] + delta_heading
     if (new_heading > math.pi):
-		temp_state[3] -= 2*math.pi
+        new_heading -= 2*math.pi
 
     if (new_heading< -math.pi):
-        temp_state[3] += 2*math.pi
-
-
-    self.LastUpdateTime = timeNow
+        new_heading += 2*math.pi
+    temp_state[3] = new_heading
 
     target_reached = self.goal_reached(temp_state, self._target_state)
     if target_reached:
         reward = 1
-    print("Next state" ,temp_state)
+    logger.debug("Next state %s", temp_state)
     self._state = temp_state
     return reward
 
@@ -139,7 +238,7 @@ class Vehicle_Controller(object):
 
   def state(self):
     """Return current state."""
-    return self._state
+    return np.array(self._state, dtype=np.float64)
 
   def print_state(self):
     """Prints the current state."""
@@ -152,6 +251,204 @@ class Vehicle_Controller(object):
     print("Current State: ", self._state, "\t", "Target: ", self._target_state)
 
 
+
+def random_target_states(count):
+  """Draws <count> random points to follow, placed like
+  add_random_point_to_follow, with steering and heading in radians: the
+  steering within the range of STEERING_ANGLES, the heading in [-pi, pi]."""
+  targets = np.empty((count, 4))
+  targets[:, 0:2] = np.random.uniform(-50.0, 50.0, size=(count, 2))
+  targets[:, 2] = np.random.uniform(STEERING_ANGLES.min(),
+                                    STEERING_ANGLES.max(), size=count)
+  targets[:, 3] = np.random.uniform(-math.pi, math.pi, size=count)
+  return targets
+
+
+# Large odd multipliers that mix grid coordinates into one hash key
+_HASH_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+                              0x165667B19E3779F9, 0x27D4EB2F165667C5],
+                             dtype=np.uint64)
+
+
+def quantized_keys(states, resolution):
+  """Hashes (N, 4) states, snapped to a grid of <resolution>, to (N,) uint64
+  keys. States in the same grid cell get the same key."""
+  cells = np.floor(np.asarray(states, dtype=np.float64) /
+                   resolution).astype(np.int64).view(np.uint64)
+  multipliers = _HASH_MULTIPLIERS[np.arange(cells.shape[1]) %
+                                  len(_HASH_MULTIPLIERS)]
+  return (cells * multipliers).sum(axis=1, dtype=np.uint64)
+
+
+def goals_reached(states, target_states):
+  """Vectorized goal_reached() for (N, 4) arrays of states and targets.
+
+  Returns:
+    A (N,) bool array, True where the vehicle is within GOAL_TOLERANCES of its
+        target.
+  """
+  return np.all(((states - GOAL_TOLERANCES) < target_states) &
+                (target_states <= (states + GOAL_TOLERANCES)), axis=1)
+
+
+class VectorVehicleController(object):
+  """Simulates a batch of vehicles, stepping all of them at once.
+
+  The poses and targets of the N vehicles are kept in (N, 4) arrays of
+  [x, y, steering, heading] and every step applies the same bicycle kinematics
+  as Vehicle_Controller.do_action() to all of them with a fixed timestep,
+  looking up the motion of each action in motion_table().
+  Vehicles that reached their goal, left the square |x|, |y| <= position_bound
+  or used up max_steps actions are reset to their initial state.
+  """
+
+  def __init__(self, num_vehicles, initial_state=None, target_state=None,
+               dt=SIMULATION_TIMESTEP, max_steps=MAX_EPISODE_STEPS,
+               position_bound=POSITION_BOUND):
+    """Init VectorVehicleController.
+
+    Args:
+      num_vehicles: Number of vehicles to simulate.
+      initial_state: Start state of every vehicle, either a single state or a
+          (num_vehicles, 4) array. Defaults to [0, 0, 0, 0].
+      target_state: Target of every vehicle, either a single state or a
+          (num_vehicles, 4) array. If None, random targets are drawn and
+          redrawn on every reset.
+      dt: Simulated time in seconds that passes with every step.
+      max_steps: Maximum number of actions per game, or None.
+      position_bound: A game is lost if |x| or |y| exceeds it.
+    """
+    self.num_vehicles = num_vehicles
+    self.dt = dt
+    self.max_steps = max_steps
+    self.position_bound = position_bound
+    self.steps = np.zeros((num_vehicles,), dtype=np.int64)
+    self._motion_table = motion_table(dt)
+    self.stop_simulation = np.zeros((num_vehicles,), dtype=bool)
+    if initial_state is None:
+      initial_state = [0, 0, 0, 0]
+    self._initial_states = np.zeros((num_vehicles, 4))
+    self._initial_states[:] = initial_state
+    self._random_targets = target_state is None
+    self._fixed_target_states = None
+    if not self._random_targets:
+      self._fixed_target_states = np.zeros((num_vehicles, 4))
+      self._fixed_target_states[:] = target_state
+    self._states = np.copy(self._initial_states)
+    self._target_states = np.zeros((num_vehicles, 4))
+    self.reset(np.arange(num_vehicles))
+
+  def reset(self, indices):
+    """Resets the vehicles at <indices> to their start and (new) targets."""
+    self._states[indices] = self._initial_states[indices]
+    if self._random_targets:
+      self._target_states[indices] = random_target_states(len(indices))
+    else:
+      self._target_states[indices] = self._fixed_target_states[indices]
+    self.stop_simulation[indices] = False
+    self.steps[indices] = 0
+
+  def do_actions(self, actions):
+    """Performs one action per vehicle.
+
+    Args:
+      actions: A (N,) int array of action indices.
+
+    Returns:
+      next_states, rewards, game_over, truncated where next_states is a (N, 4)
+          array of the states reached by the actions, rewards a (N,) array and
+          game_over and truncated (N,) bool arrays. Vehicles with game_over or
+          truncated set have already been reset, so states() returns their new
+          start state.
+    """
+    states = self._states
+    local_dx, local_dy, delta_heading, steering = self._motion_table[actions].T
+
+    heading = states[:, 3]
+    cos_heading = np.cos(heading)
+    sin_heading = np.sin(heading)
+    states[:, 0] += cos_heading * local_dx - sin_heading * local_dy
+    states[:, 1] += sin_heading * local_dx + cos_heading * local_dy
+    states[:, 2] = steering
+
+    new_heading = heading + delta_heading
+    new_heading[new_heading > math.pi] -= 2 * math.pi
+    new_heading[new_heading < -math.pi] += 2 * math.pi
+    states[:, 3] = new_heading
+
+    target_reached = goals_reached(states, self._target_states)
+    rewards = target_reached.astype(np.float64)
+    out_of_bounds = np.any(np.abs(states[:, :2]) > self.position_bound, axis=1)
+    game_over = target_reached | self.stop_simulation | out_of_bounds
+    self.steps += 1
+    if self.max_steps is None:
+      truncated = np.zeros_like(game_over)
+    else:
+      truncated = np.logical_not(game_over) & (self.steps >= self.max_steps)
+    next_states = np.copy(states)
+
+    finished = np.flatnonzero(game_over | truncated)
+    if len(finished):
+      self.reset(finished)
+    return next_states, rewards, game_over, truncated
+
+  def states(self):
+    """Return a copy of the current (N, 4) states."""
+    return np.copy(self._states)
+
+  def target_states(self):
+    """Return a copy of the current (N, 4) targets."""
+    return np.copy(self._target_states)
+
+
+def _trigonometric_step(state, action, deltaT):
+  """Moves state by recomputing the arc from scratch, without motion_table().
+
+  Reference for benchmark_motion_table().
+  """
+  steering = (math.pi/4) + ((int(ACTION_NAMES[action])-100)/(400-100))*(-math.pi/2)
+  steering = max(-ACT_STEERING_MAX_ANGLE_RANGE / 2,
+                 min(ACT_STEERING_MAX_ANGLE_RANGE / 2, steering))
+  tan_steer = math.tan(steering)
+  if (abs(tan_steer) < SMALL):
+      tan_steer = SMALL
+  backradius = VEHICLEWHEEL2WHEELLENGTH/tan_steer
+  delta_arc_angle = velocity*deltaT / backradius
+  centerx = state[0] - math.sin(state[3])*backradius
+  centery = state[1] + math.cos(state[3])*backradius
+  new_heading = state[3] + delta_arc_angle
+  return [centerx + math.sin(new_heading)*backradius,
+          centery - math.cos(new_heading)*backradius, steering, new_heading]
+
+
+def benchmark_motion_table(num_steps=100000, deltaT=SIMULATION_TIMESTEP):
+  """Compares the time per step of _trigonometric_step() and motion_table().
+
+  Returns:
+    A dict with the mean time per step in microseconds of both paths.
+  """
+  actions = np.random.randint(NUM_OF_ACTIONS, size=num_steps).tolist()
+
+  state = [0.0, 0.0, 0.0, 0.0]
+  start = time.time()
+  for action in actions:
+    state = _trigonometric_step(state, action, deltaT)
+  trigonometric_us = (time.time() - start) / num_steps * 1e6
+
+  state = [0.0, 0.0, 0.0, 0.0]
+  table = motion_table(deltaT).tolist()
+  start = time.time()
+  for action in actions:
+    local_dx, local_dy, delta_heading, steering = table[action]
+    cos_heading = math.cos(state[3])
+    sin_heading = math.sin(state[3])
+    state = [state[0] + cos_heading*local_dx - sin_heading*local_dy,
+             state[1] + sin_heading*local_dx + cos_heading*local_dy,
+             steering, state[3] + delta_heading]
+  table_us = (time.time() - start) / num_steps * 1e6
+
+  return {"trigonometric_us": trigonometric_us, "motion_table_us": table_us}
+
 #  --------------------------------------------------- TO BE REMOVED -------------------------------------------------#
 '''
   def _result_of_action_forward_x(self):
@@ -180,6 +477,8 @@ def main():
     state = [0, 0, 0]
     target = [[7.04127043363047, 6.07706071711253, 127.05753848640688], [77.04127043363047, 67.07706071711253, 127.05753848640688], [177.04127043363047, 267.07706071711253, 127.05753848640688]]
     move_in_x = 0
+    # Imported here, simulation alone does not need matplotlib.
+    import matplotlib.pyplot as plt
     fig = plt.figure()
     plt.ion()
     ax = fig.add_subplot (111)